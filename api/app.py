@@ -7,18 +7,73 @@ from flask_cors import CORS
 from .data import DBObject, Page, PageVersion
 
 
-def create_app():
+def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     CORS(app)
     app.config.from_mapping(
-        SECRET_KEY='dev', DATABASE=Path(__file__).parent / 'wiki.sqlite3')
+        SECRET_KEY='dev',
+        DATABASE=Path(__file__).parent / 'wiki.sqlite3',
+        PAGE_SIZE=100,
+        RENDER_CACHE_SIZE=1024,
+        DIFF_CACHE_SIZE=256,
+        CHANGES_MAX_WAIT=30,
+        ASGI_WORKERS=16,
+        MAX_PAGE_SIZE=1000,
+        VERSION_KEYFRAME_INTERVAL=20,
+        TOKEN_CACHE_SIZE=1024,
+        TOKEN_CACHE_TTL=300,
+        PASSWORD_HASH_ITERATIONS=100000,
+        PASSWORD_HASH_WORKERS=2,
+        AUTH_IP_RATE=1.0,
+        AUTH_IP_BURST=20,
+        AUTH_USERNAME_RATE=0.2,
+        AUTH_USERNAME_BURST=5,
+        AUTH_RATE_LIMIT_SIZE=10000,
+        AUTH_MAX_CONCURRENT_HASHES=4,
+        DB_POOL_SIZE=5,
+        DB_POOL_TIMEOUT=30,
+        SERVER_TIMING=False,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_ENCODINGS=("zstd", "br", "gzip"),
+        COMPRESS_CACHE_SIZE=256,
+        AUTO_MIGRATE=True,
+        WRITE_QUEUE=False,
+        WRITE_QUEUE_WINDOW=0.001,
+        WRITE_QUEUE_MAX_BATCH=64,
+        HISTORY_RETENTION={
+            "keep_all_days": 30,
+            "keep_daily_days": 365,
+            "keep_monthly_days": None
+        },
+        COMPACTION_BATCH_VERSIONS=200,
+        COMPACTION_BATCH_BYTES=1024 * 1024,
+        COMPACTION_PAUSE=0.05,
+        SQLITE_PRAGMAS={
+            # only takes effect on new databases, or after a full VACUUM
+            "auto_vacuum": "incremental",
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -16 * 1024,
+            "busy_timeout": 5000,
+            "foreign_keys": "on"
+        })
+
+    if test_config is None:
+        # load the instance config, if it exists, when not testing
+        app.config.from_pyfile('config.py', silent=True)
+    else:
+        app.config.from_mapping(test_config)
 
     with app.app_context():
         from . import db
         db.init_app(app)
 
-    from . import pages, auth
+    from . import encoding, pages, auth, metrics
+    encoding.init_app(app)
+    # metrics goes first so that its request hooks wrap everything else's
+    app.register_blueprint(metrics.bp)
     app.register_blueprint(pages.bp)
     app.register_blueprint(auth.bp)
 
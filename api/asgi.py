@@ -0,0 +1,364 @@
+"""
+An ASGI entry point for the wiki API.
+
+Serve it with an ASGI server, e.g.
+`uvicorn --factory api.asgi:create_asgi_app`. Requests are handled by
+the same Flask app as `api.app:create_app`, run on a bounded pool of
+threads, so the routes and models are shared. What the async side adds
+is waiting: long-polls and server-sent event streams on `/pages/changes`
+wait on the event loop instead of holding a thread each, so many idle
+clients are cheap.
+"""
+import asyncio
+import contextvars
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+from .app import create_app
+from .data import Change
+from .pages import parse_wait
+
+CHANGES_PATH = "/pages/changes"
+
+
+class AsgiApp:
+    """
+    Serve a Flask app over ASGI. Flask runs on an executor of `workers`
+    threads; password hashing still goes to the process pool configured
+    by PASSWORD_HASH_WORKERS.
+    """
+
+    def __init__(self, app, workers=32, poll_interval=1.0, keepalive=15):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.executor = None
+        self.loop = None
+        self.waiters = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        self.start()
+
+        if scope["method"] == "GET" and scope["path"] == CHANGES_PATH:
+            headers = dict(scope["headers"])
+            if b"text/event-stream" in headers.get(b"accept", b""):
+                return await self.stream_changes(scope, receive, send)
+            if "wait" in self.query(scope):
+                return await self.long_poll_changes(scope, receive, send)
+        await self.respond(scope, receive, send)
+
+    def start(self):
+        if self.executor is None:
+            self.loop = asyncio.get_running_loop()
+            self.executor = ThreadPoolExecutor(self.workers,
+                                               thread_name_prefix="asgi")
+            Change.listeners.add(self.changed)
+
+    def stop(self):
+        Change.listeners.discard(self.changed)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def run(self, context, function, *args):
+        """
+        Run `function(*args)` on the executor in `context`. All the calls
+        for one request share a context, since Flask's context variables
+        are set in one call and reset in a later one when the response is
+        streamed, likely on another thread.
+        """
+        return await self.loop.run_in_executor(self.executor, context.run,
+                                               function, *args)
+
+    async def respond(self, scope, receive, send):
+        """
+        Run the request through the Flask app and send its response,
+        pulling the body from the WSGI iterable chunk by chunk so that
+        streamed responses stay streamed.
+        """
+        body = await read_body(receive)
+        context = contextvars.Context()
+        status, headers, chunks = await self.run(context, self.call_wsgi,
+                                                 environ(scope, body))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers
+            })
+            while True:
+                chunk = await self.run(context, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True
+                    })
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await self.run(context, chunks.close)
+
+    def call_wsgi(self, environ):
+        """
+        Call the WSGI app and return the status code, the headers as
+        ASGI expects them and an iterator over the body.
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(name.lower().encode("latin-1"),
+                                    value.encode("latin-1"))
+                                   for name, value in headers]
+
+        iterable = self.app(environ, start_response)
+        iterator = iter(iterable)
+        # generator-based apps only call start_response when first iterated
+        first = next(iterator, None) if "status" not in response else None
+        chunks = Chunks(iterable, iterator, first)
+        return response["status"], response["headers"], chunks
+
+    def call_buffered(self, environ):
+        status, headers, chunks = self.call_wsgi(environ)
+        try:
+            return status, headers, b"".join(chunks)
+        finally:
+            chunks.close()
+
+    async def fetch_changes(self, scope, since):
+        """
+        Ask the Flask app for the changes after `since` without waiting.
+        The body is read here, so it is asked for uncompressed.
+        """
+        query = self.query(scope)
+        query.pop("wait", None)
+        if since is not None:
+            query["since"] = str(since)
+        scope = dict(scope,
+                     query_string=urlencode(query).encode("latin-1"),
+                     headers=[(name, value) for name, value in scope["headers"]
+                              if name not in (b"accept", b"accept-encoding",
+                                              b"last-event-id")])
+        return await self.run(contextvars.Context(), self.call_buffered,
+                              environ(scope, b""))
+
+    async def long_poll_changes(self, scope, receive, send):
+        query = self.query(scope)
+        deadline = time.monotonic() + parse_wait(
+            query["wait"], self.app.config['CHANGES_MAX_WAIT'])
+        since = query.get("since")
+        while True:
+            status, headers, body = await self.fetch_changes(scope, since)
+            remaining = deadline - time.monotonic()
+            if (status != 200 or json.loads(body)["changes"]
+                    or remaining <= 0):
+                break
+            await self.wait_for_change(min(remaining, self.poll_interval))
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def stream_changes(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        since = headers.get(b"last-event-id",
+                            self.query(scope).get("since", "").encode())
+        since = since.decode("latin-1") or None
+
+        # send errors, like a bad limit, as a plain response
+        status, headers, body = await self.fetch_changes(scope, since)
+        if status != 200:
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"),
+                        (b"cache-control", b"no-cache")]
+        })
+        await send({
+            "type": "http.response.body",
+            "body": b"retry: 1000\n\n",
+            "more_body": True
+        })
+        keepalive_at = time.monotonic() + self.keepalive
+        try:
+            while status == 200 and not disconnected.done():
+                result = json.loads(body)
+                for change in result["changes"]:
+                    await send({
+                        "type": "http.response.body",
+                        "body": (f"id: {change['id']}\nevent: change\n"
+                                 f"data: {json.dumps(change)}\n\n").encode(),
+                        "more_body": True
+                    })
+                since = result["next"]
+                if result["changes"]:
+                    keepalive_at = time.monotonic() + self.keepalive
+                if not result["more"]:
+                    # poll as well, for commits made by other processes
+                    # or while the changes were being fetched
+                    remaining = keepalive_at - time.monotonic()
+                    if remaining > 0:
+                        await self.wait_for_change(
+                            min(remaining, self.poll_interval), disconnected)
+                    else:
+                        await send({
+                            "type": "http.response.body",
+                            "body": b": keep-alive\n\n",
+                            "more_body": True
+                        })
+                        keepalive_at = time.monotonic() + self.keepalive
+                status, _, body = await self.fetch_changes(scope, since)
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+
+    def changed(self):
+        """Called from the committing thread when changes are committed."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake_waiters)
+
+    def wake_waiters(self):
+        for waiter in self.waiters:
+            waiter.set()
+
+    async def wait_for_change(self, timeout, cancelled=None):
+        """
+        Wait until changes are committed in this process, for at most
+        `timeout` seconds, or until `cancelled` is done. Returns True if
+        there were changes.
+        """
+        waiter = asyncio.Event()
+        self.waiters.add(waiter)
+        waiting = [asyncio.ensure_future(waiter.wait())]
+        if cancelled is not None:
+            waiting.append(cancelled)
+        try:
+            await asyncio.wait(waiting,
+                               timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.waiters.discard(waiter)
+            waiting[0].cancel()
+        return waiter.is_set()
+
+    @staticmethod
+    def query(scope):
+        return dict(parse_qsl(scope["query_string"].decode("latin-1")))
+
+
+class Chunks:
+    """
+    An iterator over a WSGI response body that puts back the first
+    chunk if it had to be read early, and closes the iterable.
+    """
+
+    def __init__(self, iterable, iterator, first):
+        self.iterable = iterable
+        self.iterator = iterator
+        self.first = first
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first is not None:
+            first, self.first = self.first, None
+            return first
+        return next(self.iterator)
+
+    def close(self):
+        if hasattr(self.iterable, "close"):
+            self.iterable.close()
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return body
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def environ(scope, body):
+    """
+    Build the WSGI environ for an ASGI HTTP request.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    return AsgiApp(app, workers=app.config['ASGI_WORKERS'])
@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import pytest
+
+from .asgi import create_asgi_app
+from .conftest import call
+from .data import Change
+
+
+@pytest.fixture
+def asgi_app(tmp_path):
+    app = create_asgi_app({
+        "DATABASE": tmp_path / "test.sqlite3",
+        "PASSWORD_HASH_ITERATIONS": 1,
+        "PASSWORD_HASH_WORKERS": 0
+    })
+    yield app
+    app.stop()
+
+
+async def register(app):
+    status, _, body = await call(app, "POST", "/auth/user/", {
+        "username": "alice",
+        "password": "secret"
+    })
+    assert status == 201
+    return [("Authorization", f"Token {json.loads(body)['token']}")]
+
+
+def test_routes_are_served(asgi_app):
+
+    async def run():
+        auth = await register(asgi_app)
+        status, _, _ = await call(asgi_app, "POST", "/pages/", {
+            "title": "Home",
+            "body": "Hello"
+        }, auth)
+        assert status == 201
+        status, headers, body = await call(asgi_app, "GET", "/pages/Home/")
+        assert status == 200
+        assert headers[b"content-type"] == b"application/json"
+        assert json.loads(body)["title"] == "Home"
+        status, _, body = await call(asgi_app, "GET", "/pages/")
+        pages = json.loads(body)["pages"]
+        assert [page["title"] for page in pages] == ["Home"]
+        status, _, _ = await call(asgi_app, "GET", "/pages/Nowhere/")
+        assert status == 404
+
+    asyncio.run(run())
+
+
+def test_long_poll_wakes_on_commit(asgi_app):
+
+    async def run():
+        # small enough that every response would be compressed
+        asgi_app.app.extensions["compressor"].min_size = 1
+        auth = await register(asgi_app)
+        _, _, body = await call(asgi_app, "GET", "/pages/changes")
+        since = json.loads(body)["next"] or 0
+        poll = asyncio.ensure_future(
+            call(asgi_app,
+                 "GET",
+                 "/pages/changes",
+                 headers=[("Accept-Encoding", "gzip")],
+                 query=f"since={since}&wait=10"))
+        await asyncio.sleep(0.1)
+        assert not poll.done()
+        await call(asgi_app, "POST", "/pages/", {
+            "title": "Home",
+            "body": "Hello"
+        }, auth)
+        status, _, body = await asyncio.wait_for(poll, 1)
+        assert status == 200
+        assert [change["title"] for change in json.loads(body)["changes"]] \
+            == ["Home"]
+
+    asyncio.run(run())
+
+
+def test_changes_are_streamed(asgi_app):
+
+    async def run():
+        auth = await register(asgi_app)
+        response = {}
+        stream = asyncio.ensure_future(
+            call(asgi_app,
+                 "GET",
+                 "/pages/changes",
+                 headers=[("Accept", "text/event-stream")],
+                 response=response))
+        await asyncio.sleep(0.1)
+        assert response["headers"][b"content-type"] == b"text/event-stream"
+        await call(asgi_app, "POST", "/pages/", {
+            "title": "Home",
+            "body": "Hello"
+        }, auth)
+        await asyncio.sleep(0.1)
+        stream.cancel()
+        events = response["body"].decode().split("\n\n")
+        assert "event: change" in events[-2]
+        assert json.loads(events[-2].split("data: ")[1])["title"] == "Home"
+
+    asyncio.run(run())
+
+
+def test_stream_polls_for_changes_from_other_processes(asgi_app):
+
+    async def run():
+        asgi_app.poll_interval = 0.05
+        asgi_app.keepalive = 0.5
+        auth = await register(asgi_app)
+        response = {}
+        stream = asyncio.ensure_future(
+            call(asgi_app,
+                 "GET",
+                 "/pages/changes",
+                 headers=[("Accept", "text/event-stream")],
+                 response=response))
+        await asyncio.sleep(0.1)
+        # commits in other processes do not wake this one up
+        Change.listeners.discard(asgi_app.changed)
+        await call(asgi_app, "POST", "/pages/", {
+            "title": "Home",
+            "body": "Hello"
+        }, auth)
+        await asyncio.sleep(0.15)
+        assert b"event: change" in response["body"]
+        assert b"keep-alive" not in response["body"]
+        await asyncio.sleep(0.7)
+        stream.cancel()
+        assert b"keep-alive" in response["body"]
+
+    asyncio.run(run())
+
+
+def test_long_poll_ignores_bad_waits(asgi_app):
+
+    async def run():
+        for wait in ["nan", "inf", "-1"]:
+            status, _, _ = await asyncio.wait_for(
+                call(asgi_app, "GET", "/pages/changes", query=f"wait={wait}"),
+                1)
+            assert status == 200
+
+    asyncio.run(run())
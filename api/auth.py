@@ -1,12 +1,42 @@
+import math
 from functools import wraps
-from flask import Blueprint, g, request
+from flask import Blueprint, current_app, g, request
 
+from . import passwords
+from .cache import LRUCache
 from .data import User
-from .db import get_db
+from .db import get_db, run_write
+from .ratelimit import AuthLimits, make_limiter
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
+@bp.record_once
+def configure_token_cache(state):
+    User.token_cache = LRUCache(
+        maxsize=state.app.config['TOKEN_CACHE_SIZE'],
+        ttl=state.app.config['TOKEN_CACHE_TTL'])
+
+
+@bp.record_once
+def configure_passwords(state):
+    passwords.configure(
+        iterations=state.app.config['PASSWORD_HASH_ITERATIONS'],
+        workers=state.app.config['PASSWORD_HASH_WORKERS'])
+
+
+@bp.record_once
+def configure_rate_limits(state):
+    config = state.app.config
+    size = config['AUTH_RATE_LIMIT_SIZE']
+    state.app.extensions['auth_limits'] = AuthLimits(
+        by_ip=make_limiter(config['AUTH_IP_RATE'], config['AUTH_IP_BURST'],
+                           size),
+        by_username=make_limiter(config['AUTH_USERNAME_RATE'],
+                                 config['AUTH_USERNAME_BURST'], size),
+        max_concurrent=config['AUTH_MAX_CONCURRENT_HASHES'])
+
+
 def login_required(f):
 
     @wraps(f)
@@ -18,12 +48,45 @@ def login_required(f):
     return decorated_function
 
 
+def rate_limited(f):
+    """
+    Turn away requests that would hash a password with a 429 before any
+    hashing starts, when the client IP or the username has run out of
+    tokens, or when AUTH_MAX_CONCURRENT_HASHES hashes are already
+    running, so that logins cannot take every core from the other routes.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        limits = current_app.extensions['auth_limits']
+        data = request.get_json(silent=True) or {}
+        retry_after = limits.check(request.remote_addr, data.get('username'))
+        if retry_after:
+            return too_many_requests(retry_after)
+        if not limits.acquire():
+            return too_many_requests(1)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            limits.release()
+
+    return decorated_function
+
+
+def too_many_requests(retry_after):
+    return ({
+        "errors": ["too many requests, try again later"]
+    }, 429, {
+        "Retry-After": str(math.ceil(retry_after))
+    })
+
+
 @bp.before_app_request
 def load_user():
     if request.headers.get('Authorization') and request.headers[
             'Authorization'].startswith("Token"):
         _, token = request.headers.get('Authorization').split(" ")
-        user = User.get_by_token(get_db(), token)
+        user = User.get_cached_by_token(get_db(), token)
         g.user = user
     else:
         g.user = None
@@ -42,17 +105,18 @@ def show_user():
     return g.user.to_dict()
 
 
+@rate_limited
 def register_user():
-    db = get_db()
     data = request.get_json()
     user = User(username=data.get('username'), password=data.get('password'))
-    if user.validate(db):
-        user.save(db)
+    user.hash_new_password()
+    if run_write(user.save):
         return {"username": user.username, "token": user.token}, 201
     return {"errors": user.errors}, 422
 
 
 @bp.route('/token/', methods=['POST'])
+@rate_limited
 def get_token():
     db = get_db()
     data = request.get_json()
@@ -60,7 +124,10 @@ def get_token():
     user = User.get_by_username(db, username)
     if not user or not user.password_matches(password):
         return {"errors": ["no user with that username and password"]}
-    if not user.token:
+    if user.password_needs_rehash():
+        user.password = password
+    if user.password or not user.token:
         user.set_token()
-        user.save(db)
+        user.hash_new_password()
+        run_write(user.save)
     return {"token": user.token}
@@ -0,0 +1,119 @@
+"""
+Test fixtures shared between modules. Tests that make requests with
+the `make_client` fixture run twice: through Flask's test client and
+through the ASGI entry point.
+"""
+import asyncio
+import json
+from urllib.parse import urlsplit
+
+import pytest
+
+from .asgi import AsgiApp
+
+
+async def call(app,
+               method,
+               path,
+               body=None,
+               headers=(),
+               query="",
+               response=None):
+    """
+    Make one request to an ASGI app and return the status, headers and
+    body of the response, which are also collected in `response` as they
+    are sent.
+    """
+    body = json.dumps(body).encode() if body is not None else b""
+    headers = [(name.lower().encode(), value.encode())
+               for name, value in headers]
+    if body:
+        headers.append((b"content-type", b"application/json"))
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": headers
+    }
+    messages = [{"type": "http.request", "body": body}]
+    response = {} if response is None else response
+    response["body"] = b""
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = dict(message["headers"])
+        else:
+            response["body"] += message["body"]
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+class AsgiClient:
+    """
+    A client for a Flask app served by `AsgiApp`, with the parts of
+    Flask's test client that the tests use.
+    """
+
+    def __init__(self, app):
+        self.application = app
+        self.asgi_app = AsgiApp(app, workers=4)
+        self.loop = asyncio.new_event_loop()
+
+    def open(self, method, path, json=None, headers=None):
+        url = urlsplit(path)
+        status, response_headers, body = self.loop.run_until_complete(
+            call(self.asgi_app,
+                 method,
+                 url.path,
+                 json,
+                 list((headers or {}).items()),
+                 query=url.query))
+        return self.application.response_class(
+            body,
+            status=status,
+            headers=[(name.decode("latin-1"), value.decode("latin-1"))
+                     for name, value in response_headers.items()])
+
+    def get(self, path, **kwargs):
+        return self.open("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open("DELETE", path, **kwargs)
+
+    def close(self):
+        self.asgi_app.stop()
+        self.loop.close()
+
+
+@pytest.fixture(params=["wsgi", "asgi"])
+def make_client(request):
+    """
+    Return a function that makes a test client for a Flask app, served
+    as WSGI or ASGI depending on the parameter.
+    """
+    clients = []
+
+    def make_client(app):
+        if request.param == "wsgi":
+            return app.test_client()
+        client = AsgiClient(app)
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.close()
@@ -1,10 +1,92 @@
 import sqlite3
+import threading
+from collections import namedtuple
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
 from uuid import uuid4
 import urllib.parse
 
-from .passwords import hash_password, verify_password
+from .cache import LRUCache
+from .deltas import apply_delta, make_delta, structured_diff, unified_diff
+from .passwords import hash_password, needs_rehash, verify_password
+from .render import RenderCache, render_markdown
+from .wiki import iter_wiki_links
+
+RemovalPlan = namedtuple("RemovalPlan",
+                         ["page_id", "stored", "removed", "updates"])
+
+
+class IdentityMap:
+    """
+    The objects looked up during one unit of work, keyed by class and id
+    and by each of the class's `unique_keys`, so that looking the same row
+    up again returns the same instance without a query.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.keys = {}
+
+    def get(self, cls, column, value):
+        return self.objects.get((cls, column, value))
+
+    def add(self, obj):
+        """
+        Add an object, or update the keys of an object already added
+        after its unique columns changed.
+        """
+        self.discard(obj)
+        keys = [(type(obj), column, getattr(obj, column))
+                for column in ("id", ) + obj.unique_keys
+                if getattr(obj, column, None) is not None]
+        for key in keys:
+            self.objects[key] = obj
+        self.keys[id(obj)] = keys
+
+    def discard(self, obj):
+        for key in self.keys.pop(id(obj), []):
+            if self.objects.get(key) is obj:
+                del self.objects[key]
+
+
+def begin_write(db):
+    """
+    Take the write lock now, so that nothing read from here on can be
+    changed by another connection before this transaction ends. A
+    connection that is already in a transaction has written, and so
+    already holds the lock.
+    """
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE")
+
+
+class UnitOfWork:
+    """
+    The work done on one connection during one request. While a
+    connection has a unit of work, its `with db:` blocks do not commit;
+    everything is committed once at the end, and the callbacks given to
+    `after_commit` run then. A block that raises marks the unit of work
+    as failed so that it is rolled back instead.
+    """
+
+    def __init__(self):
+        self.identity_map = IdentityMap()
+        self.failed = False
+        self.callbacks = []
+
+    def after_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def commit(self, db):
+        db.commit()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self, db):
+        db.rollback()
+        self.callbacks = []
 
 
 class DBObject:
@@ -16,8 +98,18 @@ class DBObject:
     The default behaviors for this class assume you will have an autoincremented
     column called `id` for your primary key. If that is not the case, you
     will have to override some behavior.
+
+    `unique_keys` names the columns other than `id` that identify one
+    row. Lookups with `get_by` on those columns go through the identity
+    map of the connection's unit of work, if it has one.
+
+    `constraint_errors` maps the columns of a constraint, as SQLite names
+    them in an IntegrityError (such as "pages.title"), to the error that
+    `save` adds to `errors` when saving violates that constraint.
     """
     table_name = None
+    unique_keys = ()
+    constraint_errors = {}
 
     @classmethod
     def create_table(cls, db, recreate=False):
@@ -35,24 +127,219 @@ class DBObject:
         Drop the table for the DBObject.
         """
         with db:
-            db.execute(f"DROP TABLE {cls.table_name}")
+            db.execute(f"DROP TABLE IF EXISTS {cls.table_name}")
 
     @classmethod
-    def select(cls, db, sql_fragment="", params=None):
+    def select(cls, db, sql_fragment="", params=None, columns=None):
         """
         Run a SELECT statement and return the results as
         DBObjects. The inheriting DBObject class should implement
         an __init__ method that can take all database fields as
         arguments.
+
+        If `columns` is given, only those columns are fetched and the
+        other attributes are left at their defaults.
         """
         if params is None:
             params = []
-        sql, params = cls.select_sql(sql_fragment, params)
+        sql, params = cls.select_sql(sql_fragment, params, columns=columns)
         with db:
-            db.row_factory = sqlite3.Row
-            cursor = db.execute(sql, params)
+            cursor = cls.query(db, sql, params)
             return [cls(**row) for row in cursor.fetchall()]
 
+    @staticmethod
+    def unit_of_work(db):
+        return getattr(db, "unit_of_work", None)
+
+    @classmethod
+    def get_by(cls, db, column, value):
+        """
+        Return the object whose `column`, which should be `id` or one of
+        the `unique_keys`, is `value`, or None. Within a unit of work, an
+        object that was already looked up is returned without a query.
+        """
+        unit_of_work = cls.unit_of_work(db)
+        if unit_of_work is not None:
+            obj = unit_of_work.identity_map.get(cls, column, value)
+            if obj is not None:
+                return obj
+        objects = cls.select(db, f"WHERE {column} = ?", [value])
+        if not objects:
+            return None
+        if unit_of_work is not None:
+            unit_of_work.identity_map.add(objects[0])
+        return objects[0]
+
+    @classmethod
+    def get(cls, db, id):
+        return cls.get_by(db, "id", id)
+
+    @classmethod
+    def identify(cls, db, obj):
+        """
+        Return the instance in the identity map with the id of `obj`,
+        or add `obj` to it. Use this for objects built from rows that
+        were loaded some other way.
+        """
+        unit_of_work = cls.unit_of_work(db)
+        if unit_of_work is None:
+            return obj
+        known = unit_of_work.identity_map.get(cls, "id", obj.id)
+        if known is not None:
+            return known
+        unit_of_work.identity_map.add(obj)
+        return obj
+
+    @classmethod
+    def after_commit(cls, db, callback):
+        """
+        Run `callback` once the connection's unit of work is committed,
+        or right away if it has none.
+        """
+        unit_of_work = cls.unit_of_work(db)
+        if unit_of_work is None:
+            callback()
+        else:
+            unit_of_work.after_commit(callback)
+
+    @classmethod
+    def iter_batches(cls,
+                     db,
+                     sql_fragment="",
+                     params=None,
+                     columns=None,
+                     batch_size=500):
+        """
+        Run a SELECT statement like `select`, but yield the results as
+        lists of at most `batch_size` DBObjects, so only one batch is held
+        in memory at a time.
+        """
+        if params is None:
+            params = []
+        sql, params = cls.select_sql(sql_fragment, params, columns=columns)
+        cursor = cls.query(db, sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [cls(**row) for row in rows]
+
+    @classmethod
+    def iter_select(cls,
+                    db,
+                    sql_fragment="",
+                    params=None,
+                    columns=None,
+                    batch_size=500):
+        """
+        Run a SELECT statement and lazily yield the results as
+        DBObjects, fetching `batch_size` rows at a time.
+        """
+        for batch in cls.iter_batches(db, sql_fragment, params, columns,
+                                      batch_size):
+            yield from batch
+
+    @classmethod
+    def iter_rows(cls,
+                  db,
+                  sql_fragment="",
+                  params=None,
+                  columns=None,
+                  batch_size=500,
+                  named=True):
+        """
+        Run a SELECT statement and lazily yield the raw rows, skipping
+        the cost of building DBObjects. Rows are namedtuples of the
+        selected columns, or plain tuples if `named` is False.
+        """
+        if params is None:
+            params = []
+        sql, params = cls.select_sql(sql_fragment, params, columns=columns)
+        cursor = cls.query(db, sql, params, row_factory=None)
+        make_row = tuple
+        if named:
+            make_row = namedtuple(f"{cls.__name__}Row",
+                                  [column[0]
+                                   for column in cursor.description])._make
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield make_row(row)
+
+    @staticmethod
+    def query(db, sql, params, row_factory=sqlite3.Row):
+        """
+        Execute a query on a new cursor with its own row factory,
+        leaving the row factory of the connection alone.
+        """
+        cursor = db.cursor()
+        cursor.row_factory = row_factory
+        return cursor.execute(sql, params)
+
+    @classmethod
+    def keyset_fragment(cls,
+                        after=None,
+                        limit=None,
+                        where="",
+                        params=None,
+                        key="id",
+                        descending=False):
+        """
+        Build the SQL fragment and parameters for one page of keyset
+        pagination: rows matching `where` (a condition without the WHERE
+        keyword), ordered by `key`, that come after the `after` key value.
+
+        One row more than `limit` is requested so that `keyset_page` can
+        tell whether there is a next page.
+        """
+        params = list(params or [])
+        conditions = [f"({where})"] if where else []
+        if after is not None:
+            conditions.append(f"{key} {'<' if descending else '>'} ?")
+            params.append(after)
+
+        sql_fragment = ""
+        if conditions:
+            sql_fragment = "WHERE " + " AND ".join(conditions)
+        sql_fragment += f" ORDER BY {key} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql_fragment += " LIMIT ?"
+            params.append(limit + 1)
+        return sql_fragment, params
+
+    @staticmethod
+    def keyset_page(objects, limit, key="id"):
+        """
+        Given the objects selected with a `keyset_fragment`, return
+        the objects for this page and the `after` value for the next
+        page, or None if this is the last page.
+        """
+        if limit is None or len(objects) <= limit:
+            return objects, None
+        objects = objects[:limit]
+        return objects, getattr(objects[-1], key)
+
+    @classmethod
+    def select_after(cls,
+                     db,
+                     after=None,
+                     limit=None,
+                     where="",
+                     params=None,
+                     columns=None,
+                     key="id",
+                     descending=False):
+        """
+        Select one page of objects using keyset pagination. Returns a
+        tuple of the objects and the `after` value for the next page.
+        """
+        sql_fragment, params = cls.keyset_fragment(
+            after, limit, where, params, key=key, descending=descending)
+        objects = cls.select(db, sql_fragment, params, columns=columns)
+        return cls.keyset_page(objects, limit, key=key)
+
     @classmethod
     def create_table_sql(cls):
         """
@@ -62,12 +349,13 @@ class DBObject:
         raise NotImplementedError
 
     @classmethod
-    def select_sql(cls, sql_fragment, params):
+    def select_sql(cls, sql_fragment, params, columns=None):
         """
         Override this in order to generate the SELECT statement
         needed to get back data from your database.
         """
-        sql = f"SELECT * FROM {cls.table_name} {sql_fragment}"
+        columns = ", ".join(columns) if columns else "*"
+        sql = f"SELECT {columns} FROM {cls.table_name} {sql_fragment}"
         return sql, params
 
     def __init__(self, **kwargs):
@@ -90,18 +378,81 @@ class DBObject:
         - before_save()
         - save_sql() -- returns sql + parameters
         - after_save()
+
+        If the statement violates a constraint in `constraint_errors`,
+        the error is added to `errors` and nothing is saved.
         """
         if self.validate(db):
             self.before_save(db)
             sql, params = self.save_sql()
             with db:
-                cursor = db.execute(sql, params)
+                try:
+                    cursor = db.execute(sql, params)
+                except sqlite3.IntegrityError as error:
+                    if not self.add_constraint_error(error):
+                        raise
+                    return False
                 if self.id is None:
                     self.id = cursor.lastrowid
             self.after_save(db)
+            unit_of_work = self.unit_of_work(db)
+            if unit_of_work is not None:
+                unit_of_work.identity_map.add(self)
             return True
         return False
 
+    def add_constraint_error(self, error):
+        """
+        Add the error for the constraint that `error`, a
+        sqlite3.IntegrityError, reports to `errors`. Returns False if the
+        constraint is not in `constraint_errors`.
+        """
+        _, _, columns = str(error).partition(" constraint failed: ")
+        field_error = self.constraint_errors.get(columns)
+        if field_error is None:
+            return False
+        self.errors.append(list(field_error))
+        return True
+
+    @classmethod
+    def save_many(cls, db, objects):
+        """
+        Save many objects of this class at once. This runs the bulk
+        versions of the save hooks:
+
+        - validate_many() -- returns the objects that are valid
+        - before_save_many()
+        - save_sql() -- for each object; statements with the same SQL
+          are run together with executemany in a single transaction
+        - after_save_many()
+
+        New objects get their ids from the consecutive rowids assigned
+        during the transaction. Returns the list of saved objects.
+        """
+        objects = cls.validate_many(db, objects)
+        if not objects:
+            return objects
+        cls.before_save_many(db, objects)
+
+        statements = {}
+        for obj in objects:
+            sql, params = obj.save_sql()
+            statements.setdefault((sql, obj.id is None), []).append(
+                (obj, params))
+
+        with db:
+            for (sql, is_insert), group in statements.items():
+                db.executemany(sql, [params for _, params in group])
+                if is_insert:
+                    last_id = db.execute(
+                        "SELECT last_insert_rowid()").fetchone()[0]
+                    first_id = last_id - len(group) + 1
+                    for offset, (obj, _) in enumerate(group):
+                        obj.id = first_id + offset
+
+        cls.after_save_many(db, objects)
+        return objects
+
     def save_sql(self):
         """
         Implement this in order to generate the SQL you need to
@@ -126,7 +477,10 @@ class DBObject:
             sql, params = self.delete_sql(db)
             with db:
                 db.execute(sql, params)
-            self.after_save(db)
+            self.after_delete(db)
+            unit_of_work = self.unit_of_work(db)
+            if unit_of_work is not None:
+                unit_of_work.identity_map.discard(self)
 
     def delete_sql(self, db=None):
         """
@@ -180,14 +534,47 @@ class DBObject:
         """
         pass
 
+    @classmethod
+    def validate_many(cls, db, objects):
+        """
+        Override this to validate many objects with fewer queries than
+        calling validate() on each one. It should return the list of
+        valid objects.
+        """
+        return [obj for obj in objects if obj.validate(db)]
+
+    @classmethod
+    def before_save_many(cls, db, objects):
+        """
+        Override this for before-save actions on many objects at once.
+        """
+        for obj in objects:
+            obj.before_save(db)
+
+    @classmethod
+    def after_save_many(cls, db, objects):
+        """
+        Override this for after-save actions on many objects at once.
+        """
+        for obj in objects:
+            obj.after_save(db)
+
 
 class Page(DBObject):
     """
     A Page is one individual page in our wiki.
     The content of the page is held in the page history.
+
+    Rendered HTML is kept in `render_cache` by version id. Creating,
+    renaming or deleting a page drops the renders that link to it.
     """
 
     table_name = "pages"
+    unique_keys = ("title", )
+    constraint_errors = {"pages.title": ["title", "title must be unique"]}
+    # titles whose /pages/<title>/ URL is taken by another endpoint
+    reserved_titles = {"broken-links"}
+    render_cache = RenderCache(maxsize=1024)
 
     @classmethod
     def create_table_sql(cls):
@@ -201,26 +588,127 @@ class Page(DBObject):
     @classmethod
     def create_with_body(cls, db, title, body, user_id=None):
         page = cls(title=title)
-        if page.validate(db) and body:
-            page.save(db)
+        if not body:
+            page.validate(db)
+            page.errors.append(["body", "page must contain a body"])
+        elif page.save(db):
             version = PageVersion(body=body, page_id=page.id, user_id=user_id)
             version.save(db)
-        elif not body:
-            page.errors.append(["body", "page must contain a body"])
 
         return page
 
     @classmethod
     def get_by_title(cls, db, title):
-        pages = cls.select(db, "WHERE title = ?", [title])
+        return cls.get_by(db, "title", title)
+
+    @classmethod
+    def version_stamps(cls,
+                       db,
+                       sql_fragment="",
+                       params=None,
+                       count_versions=False):
+        """
+        Return rows with the `id` and `title` of the selected pages and
+        the `version_id` and `saved_at` of their latest version, without
+        loading any bodies. With `count_versions`, rows also have the
+        `version_count` of each page. This is enough to tell whether a
+        page has changed.
+        """
+        latest = f"""(
+            SELECT v.{{}} FROM {PageVersion.table_name} v
+            WHERE v.page_id = {cls.table_name}.id
+            ORDER BY v.saved_at DESC, v.id DESC LIMIT 1
+        )"""
+        columns = [
+            "id", "title",
+            latest.format("id") + " AS version_id",
+            latest.format("saved_at") + " AS saved_at"
+        ]
+        if count_versions:
+            columns.append(f"""(
+                SELECT COUNT(*) FROM {PageVersion.table_name} v
+                WHERE v.page_id = {cls.table_name}.id
+            ) AS version_count""")
+        return list(cls.iter_rows(db, sql_fragment, params, columns=columns))
+
+    @classmethod
+    def select_with_latest_version(cls,
+                                   db,
+                                   sql_fragment="",
+                                   params=None,
+                                   version_columns=None):
+        """
+        Select pages like `select`, but also load the most recent
+        PageVersion for every page in one extra query, instead of one
+        query per page. The `history` of each page only holds that latest
+        version, which is all `to_dict()` needs without `all_history`.
+
+        `version_columns` limits the columns loaded for the versions.
+        """
+        if params is None:
+            params = []
+        pages = cls.select(db, sql_fragment, params)
         if pages:
-            return pages[0]
+            cls.load_latest_versions(db, pages, sql_fragment, params,
+                                     version_columns)
+        return pages
+
+    @classmethod
+    def iter_with_latest_version(cls,
+                                 db,
+                                 sql_fragment="",
+                                 params=None,
+                                 version_columns=None,
+                                 batch_size=500):
+        """
+        Like `select_with_latest_version`, but lazily yield the pages,
+        loading them and their latest versions `batch_size` pages at a
+        time.
+        """
+        for pages in cls.iter_batches(db, sql_fragment, params,
+                                      batch_size=batch_size):
+            placeholders = ", ".join("?" for page in pages)
+            cls.load_latest_versions(db, pages,
+                                     f"WHERE id IN ({placeholders})",
+                                     [page.id for page in pages],
+                                     version_columns)
+            yield from pages
+
+    @classmethod
+    def load_latest_versions(cls,
+                             db,
+                             pages,
+                             sql_fragment,
+                             params,
+                             version_columns=None):
+        """
+        Load the latest version of the pages selected by `sql_fragment`
+        in one query and set it as the `history` of the matching page in
+        `pages`.
+        """
+        versions = PageVersion.select(
+            db, f"""
+            WHERE id IN (
+                SELECT (
+                    SELECT v.id FROM {PageVersion.table_name} v
+                    WHERE v.page_id = {cls.table_name}.id
+                    ORDER BY v.saved_at DESC, v.id DESC LIMIT 1
+                ) FROM {cls.table_name} {sql_fragment}
+            )""",
+            params,
+            columns=version_columns)
+        latest = {version.page_id: version for version in versions}
+        for page in pages:
+            version = latest.get(page.id)
+            page.history = [version] if version else None
 
     def __init__(self, id=None, title=None, history=None):
         super().__init__()
         self.id = id
         self.title = title
+        self.loaded_title = title if id else None
         self.history = None
+        self.history_next = None
 
     def save_sql(self):
         if self.id:
@@ -235,24 +723,126 @@ class Page(DBObject):
         if not self.title:
             self.errors.append(["title", "title is required"])
             return False
-
-        if self.id:
-            title_matches = self.select(db, "WHERE title = ? AND id != ?",
-                                        [self.title, self.id])
-        else:
-            title_matches = self.select(db, "WHERE title = ?", [self.title])
-
-        if title_matches:
-            self.errors.append(["title", "title must be unique"])
+        if self.title in self.reserved_titles:
+            self.errors.append(["title", "title is reserved"])
             return False
 
+        # unique titles are checked by the UNIQUE constraint when saving
         return True
 
-    def with_history(self, db):
-        self.history = PageVersion.select(
-            db, "WHERE page_id = ? ORDER BY saved_at DESC", [self.id])
+    @classmethod
+    def validate_many(cls, db, pages):
+        """
+        Validate many pages, checking title uniqueness with one query
+        per 500 pages and within the pages themselves.
+        """
+        titles = list({page.title for page in pages if page.title})
+        taken = {}
+        for start in range(0, len(titles), 500):
+            chunk = titles[start:start + 500]
+            placeholders = ", ".join("?" for title in chunk)
+            for page in cls.iter_select(db,
+                                        f"WHERE title IN ({placeholders})",
+                                        chunk,
+                                        columns=["id", "title"]):
+                taken[page.title] = page.id
+
+        valid = []
+        claimed = set()
+        for page in pages:
+            page.errors = []
+            if not page.title:
+                page.errors.append(["title", "title is required"])
+            elif page.title in cls.reserved_titles:
+                page.errors.append(["title", "title is reserved"])
+            elif page.title in claimed or taken.get(page.title,
+                                                    page.id) != page.id:
+                page.errors.append(["title", "title must be unique"])
+            else:
+                claimed.add(page.title)
+                valid.append(page)
+        return valid
+
+    @classmethod
+    def after_save_many(cls, db, pages):
+        PageSearch.update_titles(db, [(page.id, page.title) for page in pages])
+        renamed = [page for page in pages if page.is_renamed()]
+        if renamed:
+            Change.record_pages(db, "rename", renamed)
+        for page in pages:
+            page.forget_renders(db)
+
+    @classmethod
+    def existing_titles(cls, db, titles):
+        """
+        Return the set of the given titles that are existing pages.
+        """
+        titles = list(titles)
+        existing = set()
+        for start in range(0, len(titles), 500):
+            chunk = titles[start:start + 500]
+            placeholders = ", ".join("?" for title in chunk)
+            existing.update(
+                row.title for row in cls.iter_rows(
+                    db, f"WHERE title IN ({placeholders})", chunk,
+                    columns=["title"]))
+        return existing
+
+    def with_history(self, db, after=None, limit=None):
+        """
+        Load the versions of this page, newest first. If `after` or
+        `limit` is given, only one page of versions older than the version
+        id `after` is loaded, and `history_next` is set to the `after`
+        value for the next page.
+        """
+        if after is None and limit is None:
+            self.history = PageVersion.select(
+                db, "WHERE page_id = ? ORDER BY saved_at DESC, id DESC",
+                [self.id])
+            self.history_next = None
+        else:
+            self.history, self.history_next = PageVersion.select_after(
+                db,
+                after,
+                limit,
+                where="page_id = ?",
+                params=[self.id],
+                descending=True)
+        PageVersion.restore_bodies(db, self.history)
         return self
 
+    def diff(self, db, from_id, to_id, style="unified"):
+        """
+        Return the diff between two versions of this page, as text for
+        the "unified" style or a list of changes for "structured", or None
+        if either is not a version of this page. Only the two versions are
+        loaded, and since versions never change, diffs are kept in
+        `PageVersion.diff_cache`.
+        """
+        key = (from_id, to_id, style)
+        cached = PageVersion.diff_cache.get(key)
+        if cached is not None and cached[0] == self.id:
+            return cached[1]
+
+        versions = {
+            version.id: version
+            for version in PageVersion.select(
+                db, "WHERE page_id = ? AND id IN (?, ?)",
+                [self.id, from_id, to_id])
+        }
+        if from_id not in versions or to_id not in versions:
+            return None
+        for version in versions.values():
+            PageVersion.restore_bodies(db, [version])
+
+        old, new = versions[from_id].body, versions[to_id].body
+        if style == "structured":
+            diff = structured_diff(old, new)
+        else:
+            diff = unified_diff(old, new, str(from_id), str(to_id))
+        PageVersion.diff_cache.set(key, (self.id, diff))
+        return diff
+
     def add_version(self, db, body, user_id=None):
         version = PageVersion(body=body, page_id=self.id, user_id=user_id)
         version.save(db)
@@ -260,12 +850,79 @@ class Page(DBObject):
             self.history.insert(0, version)
         return version
 
+    def to_html(self, db):
+        """
+        Render the latest version of the page to HTML, marking links
+        to missing pages, or return None if the page has no versions.
+        Uses the history if it is loaded.
+        """
+        if not self.history:
+            self.with_history(db, limit=1)
+            if not self.history:
+                return None
+
+        version = self.history[0]
+        html = self.render_cache.get(version.id)
+        if html is None:
+            targets = {
+                link["target"]
+                for link in iter_wiki_links(version.body)
+                if link["kind"] == "link"
+            }
+            html = render_markdown(version.body,
+                                   self.existing_titles(db, targets))
+            self.render_cache.set(version.id, html, targets)
+        return html
+
+    def forget_renders(self, db=None):
+        """
+        Drop cached renders that link to this page's current or
+        previous title, and remember the current title. With a unit of
+        work, they are dropped again once it commits, in case another
+        request rendered them in between.
+        """
+        titles = []
+        if self.loaded_title and self.loaded_title != self.title:
+            titles.append(self.loaded_title)
+        if self.loaded_title != self.title:
+            titles.append(self.title)
+        self.loaded_title = self.title
+
+        def forget():
+            for title in titles:
+                self.render_cache.forget_title(title)
+
+        forget()
+        if titles and db is not None:
+            self.after_commit(db, forget)
+
+    def is_renamed(self):
+        return self.loaded_title is not None and self.loaded_title != self.title
+
+    def after_save(self, db):
+        PageSearch.update_title(db, self.id, self.title)
+        if self.is_renamed():
+            Change.record_pages(db, "rename", [self])
+        self.forget_renders(db)
+
     def before_delete(self, db):
         sql = f"DELETE FROM {PageVersion.table_name} WHERE page_id = ?"
         with db:
             db.execute(sql, [self.id])
-
-    def to_dict(self, all_history=False):
+        PageSearch.remove_page(db, self.id)
+        Link.remove_page(db, self.id)
+        Change.record_pages(db, "delete", [self])
+        title = self.title
+        self.render_cache.forget_title(title)
+        self.after_commit(db, lambda: self.render_cache.forget_title(title))
+
+    def to_dict(self, all_history=False, fields=None):
+        """
+        Turn the page into a dictionary. If `fields` is given, only
+        those top-level keys are included.
+        """
+        if fields is not None and "history" not in fields:
+            all_history = False
         retval = {
             "id": self.id,
             "title": self.title,
@@ -277,15 +934,33 @@ class Page(DBObject):
             retval['updated_by'] = self.history[0].user_id
             if all_history:
                 retval['history'] = [{
+                    "id": version.id,
                     "body": version.body,
                     "saved_at": version.saved_at,
                     "user_id": version.user_id
                 } for version in self.history]
+        if fields is not None:
+            retval = {
+                key: value
+                for key, value in retval.items() if key in fields
+            }
         return retval
 
 
 class PageVersion(DBObject):
+    """
+    One saved version of a page body.
+
+    To save space, only keyframes store their full `body`. Every version
+    in between stores a compressed `delta` against the previous version
+    of the page, plus the full body while it is the newest version so that
+    the current text is cheap to read. A keyframe is written every
+    `keyframe_interval` versions; an interval of 1 stores every body
+    in full.
+    """
     table_name = 'page_versions'
+    keyframe_interval = 20
+    diff_cache = LRUCache(maxsize=256)
 
     @classmethod
     def create_table_sql(cls):
@@ -295,35 +970,254 @@ class PageVersion(DBObject):
             page_id INTEGER REFERENCES pages(id),
             body TEXT,
             user_id INTEGER REFERENCES users(id) NULL,
-            saved_at TIMESTAMP
+            saved_at TIMESTAMP,
+            delta BLOB
         )
         """
 
+    @classmethod
+    def create_table(cls, db, recreate=False):
+        """
+        Create the table, adding the `delta` column to tables created
+        before it existed.
+        """
+        super().create_table(db, recreate)
+        columns = [
+            row[1]
+            for row in db.execute(f"PRAGMA table_info({cls.table_name})")
+        ]
+        if "delta" not in columns:
+            with db:
+                db.execute(
+                    f"ALTER TABLE {cls.table_name} ADD COLUMN delta BLOB")
+
+    @classmethod
+    def restore_bodies(cls, db, versions):
+        """
+        Fill in the `body` of versions that only have a delta. The
+        versions given for each page must be consecutive, as loaded by
+        `Page.with_history`. If the oldest of them has no body, the
+        versions back to the previous stored body are loaded, without
+        the other columns, to replay the deltas.
+        """
+        pages = {}
+        for version in sorted(versions, key=lambda version: version.id):
+            pages.setdefault(version.page_id, []).append(version)
+
+        for page_id, page_versions in pages.items():
+            if all(version.body is not None for version in page_versions):
+                continue
+
+            chain = []
+            first_id = page_versions[0].id
+            if page_versions[0].body is None:
+                chain = cls.select(
+                    db, f"""
+                    WHERE page_id = ? AND id < ? AND id >= (
+                        SELECT MAX(id) FROM {cls.table_name}
+                        WHERE page_id = ? AND id < ? AND body IS NOT NULL
+                    ) ORDER BY id""", [page_id, first_id, page_id, first_id],
+                    columns=["id", "page_id", "body", "delta"])
+
+            body = None
+            for version in chain + page_versions:
+                if version.body is None:
+                    version.body = apply_delta(body, version.delta)
+                body = version.body
+        return versions
+
+    @classmethod
+    def compress_history(cls, db, page_id):
+        """
+        Rewrite the stored versions of a page to use keyframes and
+        deltas. Returns the number of versions stored as deltas.
+        """
+        versions = cls.restore_bodies(
+            db, cls.select(db, "WHERE page_id = ? ORDER BY id", [page_id]))
+        updates = []
+        previous = None
+        for position, version in enumerate(versions):
+            if position % cls.keyframe_interval == 0:
+                body, delta = version.body, None
+            else:
+                delta = make_delta(previous.body, version.body)
+                body = version.body if version is versions[-1] else None
+            updates.append([body, delta, version.id])
+            previous = version
+
+        with db:
+            db.executemany(
+                f"UPDATE {cls.table_name} SET body = ?, delta = ? "
+                "WHERE id = ?", updates)
+        return sum(1 for _, delta, _ in updates if delta is not None)
+
+    @classmethod
+    def remove_versions(cls, db, page_id, version_ids):
+        """
+        Delete some of the versions of a page, keeping the delta chains
+        valid. Returns the number of versions deleted, which is 0 if the
+        versions changed while the removal was planned.
+        """
+        return cls.apply_removal(db,
+                                 cls.plan_removal(db, page_id, version_ids))
+
+    @classmethod
+    def plan_removal(cls, db, page_id, version_ids):
+        """
+        Work out how to delete some of the versions of a page: the
+        versions that are left are stored again as keyframes and deltas,
+        and only those whose stored form changes are updated. The newest
+        version cannot be removed.
+
+        This only reads, so the bodies can be restored and the deltas
+        made outside of a write transaction. Returns a `RemovalPlan` with
+        the page's versions as they were stored, the ids to delete and
+        the [body, delta, id] rows to update.
+        """
+        version_ids = set(version_ids)
+        versions = cls.select(db, "WHERE page_id = ? ORDER BY id", [page_id])
+        if not versions or versions[-1].id in version_ids:
+            raise ValueError("the newest version of a page cannot be removed")
+        stored = {
+            version.id: (version.body, version.delta)
+            for version in versions
+        }
+        cls.restore_bodies(db, versions)
+
+        kept = [
+            version for version in versions if version.id not in version_ids
+        ]
+        updates = []
+        for position, version in enumerate(kept):
+            if position % cls.keyframe_interval == 0:
+                body, delta = version.body, None
+            else:
+                delta = make_delta(kept[position - 1].body, version.body)
+                body = version.body if version is kept[-1] else None
+            if stored[version.id] != (body, delta):
+                updates.append([body, delta, version.id])
+
+        removed = [[version.id] for version in versions
+                   if version.id in version_ids]
+        return RemovalPlan(page_id, stored, removed, updates)
+
+    @classmethod
+    def apply_removal(cls, db, plan):
+        """
+        Write a plan from `plan_removal`, if the page's versions are still
+        stored as they were when it was made; otherwise leave them alone
+        for a later run. The check and the writes happen under the write
+        lock. Returns the number of versions deleted.
+        """
+        with db:
+            begin_write(db)
+            rows = db.execute(
+                f"SELECT id, body, delta FROM {cls.table_name} "
+                "WHERE page_id = ?", [plan.page_id])
+            if {id: (body, delta) for id, body, delta in rows} != plan.stored:
+                return 0
+            db.executemany(f"DELETE FROM {cls.table_name} WHERE id = ?",
+                           plan.removed)
+            db.executemany(
+                f"UPDATE {cls.table_name} SET body = ?, delta = ? "
+                "WHERE id = ?", plan.updates)
+        cls.diff_cache.evict(lambda key, value: value[0] == plan.page_id)
+        return len(plan.removed)
+
     def __init__(self,
                  page_id=None,
                  id=None,
                  body=None,
                  user_id=None,
-                 saved_at=None):
+                 saved_at=None,
+                 delta=None):
         super().__init__()
         self.id = id
         self.page_id = page_id
         self.body = body
         self.saved_at = saved_at
         self.user_id = user_id
+        self.delta = delta
+        self.previous = None
 
     def save_sql(self):
         if self.id:
-            return "UPDATE page_versions SET page_id = ?, body = ?, saved_at = ?, user_id = ? WHERE id = ?", [
-                self.page_id, self.body, self.saved_at, self.user_id, self.id
+            return "UPDATE page_versions SET page_id = ?, body = ?, saved_at = ?, user_id = ?, delta = ? WHERE id = ?", [
+                self.page_id, self.body, self.saved_at, self.user_id,
+                self.delta, self.id
             ]
 
-        return "INSERT INTO page_versions (page_id, body, user_id, saved_at) VALUES (?, ?, ?, ?)", [
-            self.page_id, self.body, self.user_id, self.saved_at
+        return "INSERT INTO page_versions (page_id, body, user_id, saved_at, delta) VALUES (?, ?, ?, ?, ?)", [
+            self.page_id, self.body, self.user_id, self.saved_at, self.delta
         ]
 
     def before_save(self, db=None):
+        # take the write lock before reading the version a new one is a
+        # delta against, so that no other save can slip in between
+        if self.id is None:
+            begin_write(db)
         self.saved_at = datetime.now()
+        if self.id is None:
+            self.delta = self.make_delta(db)
+
+    def make_delta(self, db):
+        """
+        Return the delta to store for a new version, or None if it
+        should be a keyframe. The previous newest version is kept in
+        `self.previous` so that its cached body can be dropped.
+        """
+        row = self.query(
+            db, f"""
+            SELECT *, (
+                SELECT COUNT(*) FROM {self.table_name}
+                WHERE page_id = ? AND id > (
+                    SELECT COALESCE(MAX(id), 0) FROM {self.table_name}
+                    WHERE page_id = ? AND delta IS NULL
+                )
+            ) AS since_keyframe FROM {self.table_name}
+            WHERE page_id = ? ORDER BY id DESC LIMIT 1""",
+            [self.page_id] * 3).fetchone()
+        self.previous = None
+        if row is None:
+            return None
+        row = dict(row)
+        since_keyframe = row.pop("since_keyframe")
+        self.previous = PageVersion(**row)
+        if since_keyframe + 1 >= self.keyframe_interval:
+            return None
+
+        self.restore_bodies(db, [self.previous])
+        return make_delta(self.previous.body, self.body)
+
+    @classmethod
+    def before_save_many(cls, db, versions):
+        """
+        Versions saved in bulk are all stored as keyframes, which skips
+        looking up the previous version of each page. Run
+        `compress_history` to store them as deltas later.
+        """
+        saved_at = datetime.now()
+        for version in versions:
+            version.saved_at = saved_at
+            version.delta = None
+
+    @classmethod
+    def after_save_many(cls, db, versions):
+        bodies = {version.page_id: version.body for version in versions}
+        PageSearch.index_pages(db, list(bodies.items()))
+        Link.index_pages(db, list(bodies.items()))
+        Change.record_versions(db, versions)
+
+    def after_save(self, db):
+        if self.previous is not None and self.previous.delta is not None:
+            with db:
+                db.execute(
+                    f"UPDATE {self.table_name} SET body = NULL WHERE id = ?",
+                    [self.previous.id])
+        self.previous = None
+        PageSearch.index_page(db, self.page_id, self.body)
+        Link.index_page(db, self.page_id, self.body)
+        Change.record_versions(db, [self])
 
     def validate(self, db=None):
         if not (self.body and self.page_id):
@@ -331,8 +1225,403 @@ class PageVersion(DBObject):
         return True
 
 
+class PageSearch(DBObject):
+    """
+    A full-text index over the title and latest body of every page,
+    kept in an FTS5 virtual table whose rowid is the page id. It is kept
+    up to date by the Page and PageVersion hooks, so only the page being
+    saved or deleted is reindexed.
+    """
+    table_name = "page_search"
+
+    @classmethod
+    def create_table_sql(cls):
+        return """
+        CREATE VIRTUAL TABLE IF NOT EXISTS page_search
+        USING fts5(title, body)
+        """
+
+    @classmethod
+    def create_table(cls, db, recreate=False):
+        """
+        Create the index, filling it from the latest page versions
+        if it did not exist yet.
+        """
+        if recreate:
+            cls.drop_table(db)
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?",
+            [cls.table_name]).fetchone()
+        super().create_table(db)
+        if not exists:
+            cls.rebuild(db)
+
+    @classmethod
+    def rebuild(cls, db):
+        """
+        Reindex every page from scratch.
+        """
+        with db:
+            db.execute(f"DELETE FROM {cls.table_name}")
+            db.execute(f"""
+                INSERT INTO {cls.table_name} (rowid, title, body)
+                SELECT pages.id, pages.title, (
+                    SELECT v.body FROM {PageVersion.table_name} v
+                    WHERE v.page_id = pages.id
+                    ORDER BY v.saved_at DESC, v.id DESC LIMIT 1
+                ) FROM {Page.table_name} pages
+                """)
+
+    @classmethod
+    def index_page(cls, db, page_id, body):
+        cls.index_pages(db, [(page_id, body)])
+
+    @classmethod
+    def index_pages(cls, db, bodies):
+        """
+        Given a list of (page_id, body) pairs, replace the indexed body
+        of those pages in one transaction.
+        """
+        with db:
+            db.executemany(f"DELETE FROM {cls.table_name} WHERE rowid = ?",
+                           [[page_id] for page_id, _ in bodies])
+            db.executemany(
+                f"""
+                INSERT INTO {cls.table_name} (rowid, title, body)
+                SELECT id, title, ? FROM {Page.table_name} WHERE id = ?
+                """, [[body, page_id] for page_id, body in bodies])
+
+    @classmethod
+    def update_title(cls, db, page_id, title):
+        cls.update_titles(db, [(page_id, title)])
+
+    @classmethod
+    def update_titles(cls, db, titles):
+        """
+        Given a list of (page_id, title) pairs, update the indexed
+        titles in one transaction.
+        """
+        with db:
+            db.executemany(
+                f"UPDATE {cls.table_name} SET title = ? WHERE rowid = ?",
+                [[title, page_id] for page_id, title in titles])
+
+    @classmethod
+    def remove_page(cls, db, page_id):
+        with db:
+            db.execute(f"DELETE FROM {cls.table_name} WHERE rowid = ?",
+                       [page_id])
+
+    @classmethod
+    def search(cls, db, query, limit=None):
+        """
+        Search the index, returning Pages ranked by bm25, each with a
+        `snippet` attribute holding the matching part of the body. Every
+        word of `query` must appear in the page; FTS5 query syntax is not
+        interpreted.
+        """
+        terms = " ".join('"' + term.replace('"', '""') + '"'
+                         for term in query.split())
+        if not terms:
+            return []
+        sql = f"""
+            SELECT rowid AS id, title,
+                snippet({cls.table_name}, 1, '**', '**', '...', 16) AS snippet
+            FROM {cls.table_name} WHERE {cls.table_name} MATCH ?
+            ORDER BY bm25({cls.table_name})
+            """
+        params = [terms]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with db:
+            rows = cls.query(db, sql, params).fetchall()
+        results = []
+        for row in rows:
+            page = Page(id=row['id'], title=row['title'])
+            page.snippet = row['snippet']
+            results.append(page)
+        return results
+
+
+class Link(DBObject):
+    """
+    A [[wiki link]] from the latest version of a page to a target title,
+    which may or may not exist. There is one link per page and target.
+    Links are kept up to date by the PageVersion and Page hooks, so only
+    the body being saved is parsed.
+    """
+    table_name = "links"
+
+    @classmethod
+    def create_table_sql(cls):
+        return """
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_id INTEGER REFERENCES pages(id),
+            target TEXT,
+            label TEXT
+        )
+        """
+
+    @classmethod
+    def create_table(cls, db, recreate=False):
+        """
+        Create the table and its indexes, filling it from the latest page
+        versions if it did not exist yet.
+        """
+        if recreate:
+            cls.drop_table(db)
+        exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                            [cls.table_name]).fetchone()
+        super().create_table(db)
+        with db:
+            db.execute("CREATE INDEX IF NOT EXISTS links_source_id "
+                       "ON links (source_id)")
+            db.execute("CREATE INDEX IF NOT EXISTS links_target "
+                       "ON links (target)")
+        if not exists:
+            bodies = ((page.id, page.history[0].body)
+                      for page in Page.iter_with_latest_version(db)
+                      if page.history)
+            while True:
+                batch = list(islice(bodies, 500))
+                if not batch:
+                    break
+                cls.index_pages(db, batch)
+
+    @classmethod
+    def index_page(cls, db, page_id, body):
+        cls.index_pages(db, [(page_id, body)])
+
+    @classmethod
+    def index_pages(cls, db, bodies):
+        """
+        Given a list of (page_id, body) pairs, replace the links from
+        those pages in one transaction.
+        """
+        rows = []
+        for page_id, body in bodies:
+            targets = {}
+            for link in iter_wiki_links(body):
+                if link["kind"] == "link":
+                    targets.setdefault(link["target"], link["label"])
+            rows.extend((page_id, target, label)
+                        for target, label in targets.items())
+
+        with db:
+            db.executemany(f"DELETE FROM {cls.table_name} WHERE source_id = ?",
+                           [[page_id] for page_id, _ in bodies])
+            db.executemany(
+                f"INSERT INTO {cls.table_name} (source_id, target, label) "
+                "VALUES (?, ?, ?)", rows)
+
+    @classmethod
+    def remove_page(cls, db, page_id):
+        with db:
+            db.execute(f"DELETE FROM {cls.table_name} WHERE source_id = ?",
+                       [page_id])
+
+    @classmethod
+    def backlinks(cls, db, title):
+        """
+        Return the pages whose latest version links to `title`.
+        """
+        return Page.select(
+            db, f"""
+            WHERE id IN (SELECT source_id FROM {cls.table_name}
+                         WHERE target = ?)
+            ORDER BY title""", [title])
+
+    @classmethod
+    def broken(cls, db, after=None, limit=None):
+        """
+        Select one page of links whose target page does not exist, with
+        their `source` page loaded. Returns a tuple of the links and the
+        `after` value for the next page.
+        """
+        links, next_after = cls.select_after(
+            db,
+            after,
+            limit,
+            where=f"""NOT EXISTS (SELECT 1 FROM {Page.table_name}
+                                  WHERE title = {cls.table_name}.target)""")
+        source_ids = list({link.source_id for link in links})
+        sources = {}
+        if source_ids:
+            sources = {
+                page.id: page
+                for page in Page.select(
+                    db, "WHERE id IN ({})".format(", ".join(
+                        "?" for id in source_ids)), source_ids)
+            }
+        for link in links:
+            link.source = sources.get(link.source_id)
+        return links, next_after
+
+    def __init__(self, id=None, source_id=None, target=None, label=None):
+        super().__init__()
+        self.id = id
+        self.source_id = source_id
+        self.target = target
+        self.label = label
+        self.source = None
+
+    def to_dict(self):
+        return {
+            "source": self.source.to_dict() if self.source else None,
+            "target": self.target,
+            "label": self.label
+        }
+
+
+class Change(DBObject):
+    """
+    The change log: one row per new page version, rename or delete, in
+    the order they happened. The id of a change is the cursor clients
+    pass back to get the changes after it. Deleted pages leave a
+    tombstone with the title they had.
+
+    Rows are written by the Page and PageVersion hooks. Whenever changes
+    are committed, `condition` is notified and the `listeners` are called,
+    from the committing thread.
+    """
+    table_name = "changes"
+    condition = threading.Condition()
+    listeners = set()
+
+    @classmethod
+    def create_table_sql(cls):
+        return """
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            page_id INTEGER,
+            title TEXT,
+            kind TEXT,
+            version_id INTEGER,
+            changed_at TIMESTAMP
+        )
+        """
+
+    @classmethod
+    def create_table(cls, db, recreate=False):
+        """
+        Create the change log, starting it with the latest version of
+        every page if it did not exist yet.
+        """
+        if recreate:
+            cls.drop_table(db)
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?",
+            [cls.table_name]).fetchone()
+        super().create_table(db)
+        if not exists:
+            with db:
+                db.execute(f"""
+                INSERT INTO {cls.table_name}
+                    (page_id, title, kind, version_id, changed_at)
+                SELECT p.id, p.title, 'version', v.id, v.saved_at
+                FROM {Page.table_name} p
+                JOIN {PageVersion.table_name} v ON v.id = (
+                    SELECT id FROM {PageVersion.table_name}
+                    WHERE page_id = p.id
+                    ORDER BY saved_at DESC, id DESC LIMIT 1
+                )
+                ORDER BY v.id""")
+
+    @classmethod
+    def record_versions(cls, db, versions):
+        """
+        Log new versions, each under the current title of its page.
+        """
+        with db:
+            db.executemany(
+                f"""
+                INSERT INTO {cls.table_name}
+                    (page_id, title, kind, version_id, changed_at)
+                SELECT id, title, 'version', ?, ? FROM {Page.table_name}
+                WHERE id = ?""", [[version.id, version.saved_at,
+                                    version.page_id] for version in versions])
+        cls.after_commit(db, cls.notify)
+
+    @classmethod
+    def record_pages(cls, db, kind, pages):
+        """
+        Log a rename or delete of each of `pages`.
+        """
+        changed_at = datetime.now()
+        with db:
+            db.executemany(
+                f"""
+                INSERT INTO {cls.table_name}
+                    (page_id, title, kind, changed_at)
+                VALUES (?, ?, ?, ?)""",
+                [[page.id, page.title, kind, changed_at] for page in pages])
+        cls.after_commit(db, cls.notify)
+
+    @classmethod
+    def notify(cls):
+        with cls.condition:
+            cls.condition.notify_all()
+        for listener in list(cls.listeners):
+            listener()
+
+    @classmethod
+    def wait(cls, timeout):
+        """
+        Wait until changes are committed in this process, or for
+        `timeout` seconds.
+        """
+        with cls.condition:
+            cls.condition.wait(timeout)
+
+    @classmethod
+    def since(cls, db, since=None, limit=None):
+        """
+        Select the changes after the cursor `since`. Returns a tuple of
+        the changes and whether there are more after them.
+        """
+        changes, next_after = cls.select_after(db, since, limit)
+        return changes, next_after is not None
+
+    def __init__(self,
+                 id=None,
+                 page_id=None,
+                 title=None,
+                 kind=None,
+                 version_id=None,
+                 changed_at=None):
+        super().__init__()
+        self.id = id
+        self.page_id = page_id
+        self.title = title
+        self.kind = kind
+        self.version_id = version_id
+        self.changed_at = changed_at
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "page_id": self.page_id,
+            "title": self.title,
+            "version_id": self.version_id,
+            "changed_at": self.changed_at
+        }
+
+
 class User(DBObject):
+    """
+    A user of the wiki. Users authenticate with their token, so token
+    lookups go through `token_cache`, which maps a token to the user's
+    id and username. Saving or deleting a user evicts their tokens.
+    """
     table_name = "users"
+    unique_keys = ("username", "token")
+    constraint_errors = {
+        "users.username": ["username", "username must be unique"]
+    }
+    token_cache = LRUCache(maxsize=1024, ttl=300)
 
     @classmethod
     def create_table_sql(cls):
@@ -347,15 +1636,27 @@ class User(DBObject):
 
     @classmethod
     def get_by_username(cls, db, username):
-        users = cls.select(db, "WHERE username = ?", [username])
-        if users:
-            return users[0]
+        return cls.get_by(db, "username", username)
 
     @classmethod
     def get_by_token(cls, db, token):
-        users = cls.select(db, "WHERE token = ?", [token])
-        if users:
-            return users[0]
+        return cls.get_by(db, "token", token)
+
+    @classmethod
+    def get_cached_by_token(cls, db, token):
+        """
+        Like `get_by_token`, but answered from `token_cache` when
+        possible. The returned user only has its id, username and token.
+        """
+        record = cls.token_cache.get(token)
+        if record is None:
+            user = cls.get_by_token(db, token)
+            if not user:
+                return None
+            record = (user.id, user.username)
+            cls.token_cache.set(token, record)
+        id, username = record
+        return cls(id=id, username=username, token=token)
 
     def __init__(self,
                  id=None,
@@ -369,17 +1670,52 @@ class User(DBObject):
         self.encrypted_password = encrypted_password
         self.password = password
         self.token = token
+        self.loaded_token = token
 
     def password_matches(self, password):
         if not self.encrypted_password:
             return False
         return verify_password(self.encrypted_password, password)
 
-    def before_save(self, db=None):
+    def password_needs_rehash(self):
+        return bool(self.encrypted_password) and needs_rehash(
+            self.encrypted_password)
+
+    def hash_new_password(self):
+        """
+        Hash a newly set `password` now rather than when saving, so that
+        the slow hash does not run while holding a write transaction.
+        """
         if self.password:
             self.encrypted_password = hash_password(self.password)
+            self.password = None
+
+    def before_save(self, db=None):
+        self.hash_new_password()
         self.set_token()
 
+    def after_save(self, db=None):
+        self.forget_tokens(db)
+        self.loaded_token = self.token
+
+    def after_delete(self, db=None):
+        self.forget_tokens(db)
+
+    def forget_tokens(self, db=None):
+        """
+        Drop the user's current and previous tokens from the cache, and
+        again once the unit of work commits, if there is one.
+        """
+        tokens = (self.loaded_token, self.token)
+
+        def forget():
+            for token in tokens:
+                self.token_cache.pop(token)
+
+        forget()
+        if db is not None:
+            self.after_commit(db, forget)
+
     def set_token(self):
         if not self.token:
             self.token = str(uuid4())
@@ -401,17 +1737,6 @@ class User(DBObject):
             self.errors.append(['username', 'username is required'])
             return False
 
-        if self.id:
-            username_matches = self.select(db, "WHERE username = ? AND id != ?",
-                                           [self.username, self.id])
-        else:
-            username_matches = self.select(db, "WHERE username = ?",
-                                           [self.username])
-
-        if username_matches:
-            self.errors.append(['username', 'username must be unique'])
-            return False
-
         if not self.password and not self.encrypted_password:
             self.errors.append(['password', 'password is required'])
             return False
@@ -423,18 +1748,14 @@ class User(DBObject):
 
 
 def load_pages(db_path):
+    from .importer import import_pages
+
     db = sqlite3.connect(db_path)
     PageVersion.create_table(db, recreate=True)
     Page.create_table(db, recreate=True)
+    PageSearch.create_table(db, recreate=True)
+    Link.create_table(db, recreate=True)
+    Change.create_table(db, recreate=True)
 
     pages_dir = Path(__file__).parent / '..' / 'pages'
-    pages = pages_dir.glob("*.md")
-    for page_path in pages:
-        with open(page_path, 'r') as file:
-            title = file.readline().strip()
-            body = file.read().strip()
-            print(title)
-            page = Page(title=title)
-            page.save(db)
-            version = PageVersion(body=body, page_id=page.id)
-            version.save(db)
+    import_pages(db, pages_dir)
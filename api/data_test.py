@@ -2,7 +2,7 @@ import sqlite3
 
 import pytest
 
-from .data import DBObject
+from .data import Change, DBObject, Link, Page, PageSearch, PageVersion, User
 
 
 class Widget(DBObject):
@@ -77,3 +77,307 @@ def test_deleting_widget_from_db(db):
 
     widgets = Widget.select(db, "WHERE id = ?", [widget.id])
     assert widgets == []
+
+
+@pytest.fixture
+def wiki_db():
+    db = sqlite3.connect(":memory:")
+    Page.create_table(db)
+    PageVersion.create_table(db)
+    PageSearch.create_table(db)
+    Link.create_table(db)
+    Change.create_table(db)
+    return db
+
+
+def test_select_with_latest_version(wiki_db):
+    first = Page.create_with_body(wiki_db, "First", "one")
+    first.add_version(wiki_db, "two")
+    Page.create_with_body(wiki_db, "Second", "only")
+    Page(title="Empty").save(wiki_db)
+
+    pages = {
+        page.title: page
+        for page in Page.select_with_latest_version(wiki_db)
+    }
+    assert pages["First"].to_dict()["body"] == "two"
+    assert pages["Second"].to_dict()["body"] == "only"
+    assert "body" not in pages["Empty"].to_dict()
+
+    pages = Page.select_with_latest_version(wiki_db, "WHERE title = ?",
+                                            ["First"])
+    assert [page.title for page in pages] == ["First"]
+    assert pages[0].to_dict() == first.with_history(wiki_db).to_dict()
+
+
+def test_select_after_paginates_by_key(db):
+    for name in ["a", "b", "c"]:
+        Widget(name=name).save(db)
+
+    widgets, next_after = Widget.select_after(db, limit=2)
+    assert [widget.name for widget in widgets] == ["a", "b"]
+    assert next_after == widgets[-1].id
+
+    widgets, next_after = Widget.select_after(db, after=next_after, limit=2)
+    assert [widget.name for widget in widgets] == ["c"]
+    assert next_after is None
+
+
+def test_select_with_columns_only_loads_those_columns(db):
+    Widget(name="Test").save(db)
+    widgets = Widget.select(db, columns=["id"])
+    assert widgets[0].id is not None
+    assert widgets[0].name is None
+
+
+def test_paginated_history(wiki_db):
+    page = Page.create_with_body(wiki_db, "Page", "one")
+    page.add_version(wiki_db, "two")
+    page.add_version(wiki_db, "three")
+
+    page.with_history(wiki_db, limit=2)
+    assert [version.body for version in page.history] == ["three", "two"]
+
+    page.with_history(wiki_db, after=page.history_next, limit=2)
+    assert [version.body for version in page.history] == ["one"]
+    assert page.history_next is None
+
+    assert page.to_dict(fields={"title", "url"}) == {
+        "title": "Page",
+        "url": "/pages/Page/"
+    }
+
+
+def test_search_index_follows_page_changes(wiki_db):
+    page = Page.create_with_body(wiki_db, "Snakes", "pythons are large")
+    assert [p.title for p in PageSearch.search(wiki_db, "pythons")] == [
+        "Snakes"
+    ]
+
+    page.add_version(wiki_db, "boas are large")
+    assert PageSearch.search(wiki_db, "pythons") == []
+    assert [p.id for p in PageSearch.search(wiki_db, "large boas")] == [
+        page.id
+    ]
+
+    page.title = "Constrictors"
+    page.save(wiki_db)
+    assert PageSearch.search(wiki_db, "boas")[0].title == "Constrictors"
+
+    page.delete(wiki_db)
+    assert PageSearch.search(wiki_db, "boas") == []
+
+
+@pytest.fixture
+def keyframe_interval():
+    interval = PageVersion.keyframe_interval
+    PageVersion.keyframe_interval = 3
+    yield PageVersion.keyframe_interval
+    PageVersion.keyframe_interval = interval
+
+
+def stored_bodies(db, page):
+    return [
+        row[0] for row in db.execute(
+            "SELECT body FROM page_versions WHERE page_id = ? ORDER BY id",
+            [page.id])
+    ]
+
+
+def test_versions_are_stored_as_deltas(wiki_db, keyframe_interval):
+    page = Page.create_with_body(wiki_db, "Page", "v0\n")
+    for number in range(1, 5):
+        page.add_version(wiki_db, f"v{number}\n")
+
+    assert stored_bodies(wiki_db, page) == [
+        "v0\n", None, None, "v3\n", "v4\n"
+    ]
+    page.with_history(wiki_db)
+    assert [version.body for version in page.history
+           ] == ["v4\n", "v3\n", "v2\n", "v1\n", "v0\n"]
+
+    page.with_history(wiki_db, after=page.history[2].id, limit=1)
+    assert [version.body for version in page.history] == ["v1\n"]
+
+
+def test_diff_between_versions(wiki_db, keyframe_interval):
+    page = Page.create_with_body(wiki_db, "Page", "a\nv0\n")
+    ids = [page.add_version(wiki_db, f"a\nv{number}\n").id
+           for number in range(1, 5)]
+
+    assert page.diff(wiki_db, ids[0], ids[1],
+                     style="structured") == [{
+                         "op": "replace",
+                         "old_start": 2,
+                         "old": ["v1\n"],
+                         "new_start": 2,
+                         "new": ["v2\n"]
+                     }]
+    assert "-v1\n+v2\n" in page.diff(wiki_db, ids[0], ids[1])
+    assert page.diff(wiki_db, ids[0], ids[0]) == ""
+
+    other = Page.create_with_body(wiki_db, "Other", "text")
+    assert other.diff(wiki_db, ids[0], ids[1]) is None
+
+    first = other.add_version(wiki_db, "text").id
+    last = other.add_version(wiki_db, "text\nmore").id
+    assert other.diff(wiki_db, first, last).splitlines()[2:] == [
+        "@@ -1 +1,2 @@", "-text", "\\ No newline at end of file", "+text",
+        "+more", "\\ No newline at end of file"
+    ]
+
+
+def test_compress_history(wiki_db, keyframe_interval):
+    page = Page.create_with_body(wiki_db, "Page", "v0\n")
+    PageVersion.keyframe_interval = 1
+    for number in range(1, 5):
+        page.add_version(wiki_db, f"v{number}\n")
+    assert None not in stored_bodies(wiki_db, page)
+
+    PageVersion.keyframe_interval = 2
+    assert PageVersion.compress_history(wiki_db, page.id) == 2
+    assert stored_bodies(wiki_db, page) == ["v0\n", None, "v2\n", None, "v4\n"]
+    assert [version.body for version in page.with_history(wiki_db).history
+           ] == ["v4\n", "v3\n", "v2\n", "v1\n", "v0\n"]
+
+
+def test_token_lookups_are_cached_until_user_is_saved():
+    db = sqlite3.connect(":memory:")
+    User.create_table(db)
+    user = User(username="alice", encrypted_password="x")
+    user.save(db)
+
+    token = user.token
+    assert User.get_cached_by_token(db, token).id == user.id
+    db.execute("DELETE FROM users")
+    assert User.get_cached_by_token(db, token).username == "alice"
+
+    user.id = None
+    user.token = None
+    user.save(db)
+    assert User.get_cached_by_token(db, token) is None
+    assert User.get_cached_by_token(db, user.token).id == user.id
+
+
+def test_iter_select_yields_batches_lazily(db):
+    for name in ["a", "b", "c"]:
+        Widget(name=name).save(db)
+
+    batches = list(Widget.iter_batches(db, "ORDER BY id", batch_size=2))
+    assert [[widget.name for widget in batch] for batch in batches
+           ] == [["a", "b"], ["c"]]
+    assert [widget.name for widget in Widget.iter_select(db, batch_size=2)
+           ] == ["a", "b", "c"]
+
+
+def test_iter_rows(db):
+    Widget(name="a").save(db)
+    row = next(Widget.iter_rows(db, columns=["id", "name"]))
+    assert (row.id, row.name) == (1, "a")
+    assert next(Widget.iter_rows(db, columns=["name"], named=False)) == ("a", )
+
+
+def test_iter_with_latest_version(wiki_db):
+    for number in range(5):
+        page = Page.create_with_body(wiki_db, f"Page {number}", "old")
+        page.add_version(wiki_db, f"new {number}")
+
+    pages = list(Page.iter_with_latest_version(wiki_db, batch_size=2))
+    assert [page.to_dict()["body"] for page in pages
+           ] == [f"new {number}" for number in range(5)]
+
+
+def test_save_many_assigns_ids_and_validates(db):
+    widgets = [Widget(name="a"), Widget(), Widget(name="c")]
+    saved = Widget.save_many(db, widgets)
+    assert saved == [widgets[0], widgets[2]]
+    assert [widget.name for widget in Widget.select(db, "WHERE id IN (?, ?)",
+                                                    [w.id for w in saved])
+           ] == ["a", "c"]
+
+    saved[0].name = "b"
+    Widget.save_many(db, saved)
+    assert Widget.select(db, "WHERE id = ?", [saved[0].id])[0].name == "b"
+
+
+def test_save_many_pages_checks_unique_titles(wiki_db):
+    Page.create_with_body(wiki_db, "Taken", "body")
+    pages = [Page(title="Taken"), Page(title="New"), Page(title="New")]
+    assert Page.save_many(wiki_db, pages) == [pages[1]]
+    assert pages[0].errors == [["title", "title must be unique"]]
+    assert pages[2].errors == [["title", "title must be unique"]]
+
+    PageVersion.save_many(wiki_db, [PageVersion(page_id=pages[1].id,
+                                                body="searchable")])
+    assert PageSearch.search(wiki_db, "searchable")[0].title == "New"
+
+
+def test_unique_constraints_become_errors(wiki_db):
+    Page.create_with_body(wiki_db, "Taken", "body")
+    page = Page.create_with_body(wiki_db, "Taken", "other body")
+    assert page.id is None
+    assert page.errors == [["title", "title must be unique"]]
+
+    page = Page.create_with_body(wiki_db, "Free", "body")
+    page.title = "Taken"
+    assert not page.save(wiki_db)
+    assert page.errors == [["title", "title must be unique"]]
+    assert Page.get_by_title(wiki_db, "Free").id == page.id
+
+    User.create_table(wiki_db)
+    User(username="alice", encrypted_password="x").save(wiki_db)
+    user = User(username="alice", encrypted_password="y")
+    assert not user.save(wiki_db)
+    assert user.errors == [["username", "username must be unique"]]
+
+
+def test_links_follow_page_changes(wiki_db):
+    python = Page.create_with_body(wiki_db, "Python",
+                                   "A [[dynamic|Dynamic]] [[Language]].")
+    Page.create_with_body(wiki_db, "Dynamic", "See [[Python]].")
+
+    assert [page.title for page in Link.backlinks(wiki_db, "Dynamic")
+           ] == ["Python"]
+    links, _ = Link.broken(wiki_db)
+    assert [(link.source.title, link.target) for link in links
+           ] == [("Python", "Language")]
+
+    python.add_version(wiki_db, "Now links to [[Ruby]].")
+    assert Link.backlinks(wiki_db, "Dynamic") == []
+    assert [link.target for link in Link.broken(wiki_db)[0]] == ["Ruby"]
+
+    python.delete(wiki_db)
+    links, _ = Link.broken(wiki_db)
+    assert [(link.source.title, link.target) for link in links
+           ] == [("Dynamic", "Python")]
+
+
+def test_to_html_is_rerendered_when_linked_page_is_created(wiki_db):
+    page = Page.create_with_body(wiki_db, "Python", "See [[Ruby]].")
+    assert "missing" in page.to_html(wiki_db)
+
+    ruby = Page.create_with_body(wiki_db, "Ruby", "A language.")
+    assert "missing" not in page.to_html(wiki_db)
+
+    ruby.title = "Ruby language"
+    ruby.save(wiki_db)
+    assert "missing" in page.to_html(wiki_db)
+
+
+def test_change_log(wiki_db):
+    page = Page.create_with_body(wiki_db, "Python", "body")
+    version = page.add_version(wiki_db, "new body")
+    page.title = "Python 3"
+    page.save(wiki_db)
+    page.delete(wiki_db)
+
+    changes, more = Change.since(wiki_db)
+    assert not more
+    assert [(change.kind, change.title, change.version_id)
+            for change in changes] == [("version", "Python", version.id - 1),
+                                       ("version", "Python", version.id),
+                                       ("rename", "Python 3", None),
+                                       ("delete", "Python 3", None)]
+    changes, more = Change.since(wiki_db, since=changes[1].id, limit=1)
+    assert [change.kind for change in changes] == ["rename"]
+    assert more
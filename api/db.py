@@ -1,40 +1,350 @@
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
 import click
-from flask import current_app, g
-from .data import Page, PageVersion, User
+from flask import current_app, g, has_request_context
+from flask.cli import AppGroup, with_appcontext
+from . import migrations, retention
+from .data import Page, PageVersion, UnitOfWork
+from .importer import import_pages
+from .writer import WriteQueue
+from .metrics import InstrumentedConnection
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Connection(InstrumentedConnection):
+    """
+    A pooled connection. While it has a `unit_of_work`, `with db:` blocks
+    leave the transaction open for the unit of work to commit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unit_of_work = None
+
+    def __enter__(self):
+        if self.unit_of_work is None:
+            return super().__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.unit_of_work is None:
+            return super().__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            self.unit_of_work.failed = True
+        return False
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of up to `size` SQLite connections. Each
+    connection is created lazily and configured once with `pragmas`, then
+    handed to one thread at a time by `acquire` and returned by `release`.
+
+    The pool keeps count of checkouts and of the time spent waiting for
+    a free connection.
+    """
+
+    def __init__(self, database, size=5, timeout=30, pragmas=None):
+        self.database = str(database)
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(self.database,
+                             check_same_thread=False,
+                             factory=Connection)
+        for name, value in self.pragmas.items():
+            db.execute(f"PRAGMA {name} = {value}")
+        return db
+
+    def acquire(self):
+        started = time.perf_counter()
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = self._create_or_wait()
+        waited = time.perf_counter() - started
+
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return db
+
+    def _create_or_wait(self):
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(
+                f"no database connection free after {self.timeout}s")
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        self._idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the length of a `with` block, for
+        code that must not hold one for a whole request.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "connections": self._created,
+            "idle": self._idle.qsize(),
+            "checkouts": self.checkouts,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time
+        }
+
+
+def get_pool(app=None):
+    app = app or current_app
+    return app.extensions['db_pool']
 
 
 def get_db():
     """
-    Establish a per-thread connection to the database.
+    Check out a connection from the pool for the current app context.
+    Its statements are recorded in the request's query log, if any.
+
+    During a request, the connection gets a unit of work, so everything
+    the request writes is committed in one transaction when it ends.
     """
     if 'db' not in g:
-        g.db = sqlite3.connect(str(current_app.config['DATABASE']))
+        g.db = get_pool().acquire()
+        g.db.query_log = g.get('query_log')
+        if has_request_context():
+            g.db.unit_of_work = UnitOfWork()
     return g.db
 
 
+def run_write(job):
+    """
+    Run `job(db)`, which writes to the database, and return its result.
+    With WRITE_QUEUE on, it runs on the writer thread and is committed
+    when this returns; otherwise it runs on the request's connection.
+    """
+    writer = current_app.extensions.get('db_writer')
+    if writer is None:
+        return job(get_db())
+    return writer.submit(job, g.get('query_log'))
+
+
 def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        release_db(db, error=e)
+
+
+def release_db(db, pool=None, error=None):
+    """
+    Finish the connection's unit of work, committing it unless the
+    request failed, and return the connection to the pool.
+    """
+    unit_of_work, db.unit_of_work = db.unit_of_work, None
+    try:
+        if unit_of_work is not None:
+            if error is None and not unit_of_work.failed:
+                unit_of_work.commit(db)
+            else:
+                unit_of_work.rollback(db)
+    finally:
+        db.query_log = None
+        (pool or get_pool()).release(db)
+
+
+def keep_db_until_closed(response):
+    """
+    Hand the current connection over to a streamed response, which
+    returns it to the pool once the response is closed rather than when
+    the app context ends, since the stream may outlive the app context.
+    """
+    db = g.pop('db', None)
+    if db is not None:
+        pool = get_pool()
+        response.call_on_close(lambda: release_db(db, pool))
+    return response
 
 
 def init_db():
     """
-    Make sure our database tables are created.
+    Make sure our database schema is up to date. The versions applied are
+    kept for `flask db upgrade` to report.
+    """
+    current_app.extensions['db_migrated'] = migrations.upgrade(get_db())
+
+
+db_cli = AppGroup('db', help='Manage the database schema.')
+
+
+@db_cli.command('upgrade')
+@click.option('--analyze',
+              is_flag=True,
+              help='Run ANALYZE and show the plans of the model queries.')
+def upgrade_command(analyze):
+    """
+    Apply the pending schema migrations. With AUTO_MIGRATE on, they are
+    applied as the app loads, before this runs; those are reported too.
     """
     db = get_db()
-    Page.create_table(db)
-    PageVersion.create_table(db)
-    User.create_table(db)
+    versions = (current_app.extensions.pop('db_migrated', []) +
+                migrations.upgrade(db))
+    if versions:
+        click.echo(f"Applied migrations {', '.join(map(str, versions))}.")
+    else:
+        click.echo("The schema is up to date.")
+
+    if analyze:
+        with db:
+            db.execute("ANALYZE")
+        for name, sql, plan in migrations.query_plans(db):
+            click.echo(f"\n{name}: {sql}")
+            for line in plan:
+                click.echo(f"    {line}")
+
+
+@db_cli.command('compact')
+@click.option('--dry-run',
+              is_flag=True,
+              help='Only count the versions that would be removed.')
+@click.option('--full-vacuum',
+              is_flag=True,
+              help='Run a full VACUUM, which also switches an existing '
+              'database to incremental vacuum mode.')
+def compact_command(dry_run, full_vacuum):
+    """
+    Remove the page versions that the HISTORY_RETENTION policy does not
+    keep and give the space back.
+    """
+    db = get_db()
+    policy = retention.RetentionPolicy(
+        **current_app.config['HISTORY_RETENTION'])
+    if dry_run:
+        removable = retention.find_removable_versions(db, policy)
+        click.echo(f"Would remove "
+                   f"{sum(map(len, removable.values()))} versions of "
+                   f"{len(removable)} pages.")
+        return
+
+    pages, versions = retention.compact_history(
+        db,
+        policy,
+        batch_versions=current_app.config['COMPACTION_BATCH_VERSIONS'],
+        batch_bytes=current_app.config['COMPACTION_BATCH_BYTES'],
+        pause=current_app.config['COMPACTION_PAUSE'])
+    click.echo(f"Removed {versions} versions of {pages} pages.")
+    if full_vacuum:
+        size = retention.database_size(db)
+        db.execute("VACUUM")
+        reclaimed = size - retention.database_size(db)
+    else:
+        reclaimed = retention.incremental_vacuum(
+            db, pause=current_app.config['COMPACTION_PAUSE'])
+    if reclaimed is None:
+        click.echo("The database is not in incremental vacuum mode; run "
+                   "with --full-vacuum once to switch it.")
+    else:
+        click.echo(f"Reclaimed {reclaimed} bytes.")
+
+
+@click.command('compress-history')
+@click.option('--vacuum', is_flag=True, help='Run VACUUM afterwards.')
+@with_appcontext
+def compress_history_command(vacuum):
+    """
+    Convert the stored page history to keyframes and deltas.
+    """
+    db = get_db()
+    page_ids = [
+        row[0] for row in db.execute(f"SELECT id FROM {Page.table_name}")
+    ]
+    deltas = 0
+    for page_id in page_ids:
+        deltas += PageVersion.compress_history(db, page_id)
+    click.echo(f"Stored {deltas} versions of {len(page_ids)} pages as deltas.")
+    if vacuum:
+        db.execute("VACUUM")
+
+
+@click.command('import-pages')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--batch-size', default=500, show_default=True)
+@with_appcontext
+def import_pages_command(path, batch_size):
+    """
+    Import pages from a directory of .md files or an NDJSON file.
+    """
+    imported, skipped = import_pages(get_db(), path, batch_size=batch_size)
+    click.echo(f"Imported {imported} pages, skipped {skipped}.")
 
 
 def init_app(app):
     """
-    Create our database tables and ensure the DB connection is closed
-    when the app ends.
+    Set up the connection pool, bring the schema up to date unless
+    AUTO_MIGRATE is off and ensure the DB connection goes back to the pool
+    when the app context ends.
     """
+    PageVersion.keyframe_interval = app.config['VERSION_KEYFRAME_INTERVAL']
+    app.extensions['db_pool'] = ConnectionPool(
+        app.config['DATABASE'],
+        size=app.config['DB_POOL_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        pragmas=app.config['SQLITE_PRAGMAS'])
+    if app.config['WRITE_QUEUE']:
+        app.extensions['db_writer'] = WriteQueue(
+            app.extensions['db_pool'].connect,
+            window=app.config['WRITE_QUEUE_WINDOW'],
+            max_batch=app.config['WRITE_QUEUE_MAX_BATCH'])
     app.teardown_appcontext(close_db)
-    init_db()
+    app.cli.add_command(compress_history_command)
+    app.cli.add_command(import_pages_command)
+    app.cli.add_command(db_cli)
+    if app.config['AUTO_MIGRATE']:
+        init_db()
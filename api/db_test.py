@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+
+from .app import create_app
+from .data import Change, Page, PageSearch, PageVersion, UnitOfWork
+from .db import ConnectionPool, PoolTimeout, release_db
+from .migrations import upgrade
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(
+        tmp_path / "test.sqlite3",
+        size=2,
+        timeout=0.01,
+        pragmas={
+            "journal_mode": "wal",
+            "foreign_keys": "on"
+        })
+    yield pool
+    pool.close()
+
+
+def test_connections_are_configured_and_reused(pool):
+    db = pool.acquire()
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    pool.release(db)
+    assert pool.acquire() is db
+    assert pool.stats()["connections"] == 1
+
+
+def test_pool_is_bounded(pool):
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+
+def test_released_connections_are_rolled_back(pool):
+    db = pool.acquire()
+    db.execute("CREATE TABLE things (name TEXT)")
+    db.execute("INSERT INTO things VALUES ('a')")
+    pool.release(db)
+    assert pool.acquire().execute("SELECT * FROM things").fetchall() == []
+
+
+def test_connection_can_be_used_from_another_thread(pool):
+    db = pool.acquire()
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(db.execute("SELECT 1").fetchone()))
+    thread.start()
+    thread.join()
+    assert results == [(1, )]
+
+
+def test_unit_of_work_commits_once_with_identity_map(pool):
+    db = pool.acquire()
+    for model in [Page, PageVersion, PageSearch, Change]:
+        model.create_table(db)
+    db.unit_of_work = UnitOfWork()
+    page = Page(title="Python")
+    page.save(db)
+    assert db.in_transaction
+    assert Page.get_by_title(db, "Python") is page
+    page.title = "Python 3"
+    page.save(db)
+    assert Page.get_by_title(db, "Python 3") is page
+    assert Page.get(db, page.id) is page
+    release_db(db, pool)
+
+    other = pool.acquire()
+    assert [row[0] for row in other.execute("SELECT title FROM pages")
+            ] == ["Python 3"]
+
+
+def test_failed_unit_of_work_is_rolled_back(pool):
+    db = pool.acquire()
+    for model in [Page, PageVersion, PageSearch, Change]:
+        model.create_table(db)
+    db.unit_of_work = UnitOfWork()
+    Page(title="Python").save(db)
+    with pytest.raises(ZeroDivisionError):
+        with db:
+            1 / 0
+    release_db(db, pool)
+    assert pool.acquire().execute("SELECT * FROM pages").fetchall() == []
+
+
+def test_interleaved_saves_keep_delta_chains_valid(tmp_path, monkeypatch):
+    pool = ConnectionPool(tmp_path / "test.sqlite3",
+                          size=2,
+                          pragmas={
+                              "journal_mode": "wal",
+                              "busy_timeout": 5000
+                          })
+    first, second = pool.acquire(), pool.acquire()
+    upgrade(first)
+    page = Page.create_with_body(first, title="Home", body="a\nb\nc\n")
+
+    # start the second save while the first has read its delta base
+    make_delta = PageVersion.make_delta
+    threads = []
+
+    def interleaved_make_delta(self, db):
+        delta = make_delta(self, db)
+        if not threads:
+            threads.append(
+                threading.Thread(target=lambda: page.add_version(
+                    second, "x\ny\nB\n")))
+            threads[0].start()
+            threads[0].join(0.2)
+        return delta
+
+    monkeypatch.setattr(PageVersion, "make_delta", interleaved_make_delta)
+    page.add_version(first, "a\nb\nA\n")
+    threads[0].join()
+    # replaying the deltas only goes wrong once the bodies are dropped
+    page.add_version(first, "z\n")
+
+    history = Page.get(first, page.id).with_history(first).history
+    assert [version.body for version in history] == \
+        ["z\n", "x\ny\nB\n", "a\nb\nA\n", "a\nb\nc\n"]
+    pool.release(first)
+    pool.release(second)
+    pool.close()
+
+
+def test_upgrade_command_reports_migrations_applied_on_load(tmp_path):
+    config = {"DATABASE": tmp_path / "test.sqlite3"}
+    runner = create_app(config).test_cli_runner()
+    result = runner.invoke(args=["db", "upgrade"])
+    assert result.output == "Applied migrations 1, 2, 3, 4.\n"
+
+    runner = create_app(config).test_cli_runner()
+    result = runner.invoke(args=["db", "upgrade"])
+    assert result.output == "The schema is up to date.\n"
@@ -0,0 +1,80 @@
+import difflib
+import json
+import zlib
+
+
+def make_delta(old, new):
+    """
+    Given two strings, return a zlib-compressed, line-based delta that
+    turns `old` into `new` when passed to `apply_delta`.
+
+    The delta is a JSON list of operations applied to the lines of `old`
+    in order: a positive number copies that many lines, a negative number
+    skips that many lines and a string is inserted as-is.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append("".join(new_lines[j1:j2]))
+
+    return zlib.compress(json.dumps(ops, separators=(",", ":")).encode())
+
+
+def apply_delta(old, delta):
+    """
+    Rebuild the new string from `old` and a delta made by `make_delta`.
+    """
+    old_lines = old.splitlines(keepends=True)
+    position = 0
+    parts = []
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.extend(old_lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+
+def unified_diff(old, new, from_name="", to_name=""):
+    """
+    Return a unified diff of two strings as text. As in diff(1), a last
+    line without a newline is marked with "\\ No newline at end of file".
+    """
+    lines = difflib.unified_diff(old.splitlines(keepends=True),
+                                 new.splitlines(keepends=True),
+                                 fromfile=from_name,
+                                 tofile=to_name)
+    return "".join(line if line.endswith("\n") else
+                   f"{line}\n\\ No newline at end of file\n"
+                   for line in lines)
+
+
+def structured_diff(old, new):
+    """
+    Return the changes between two strings as a list of dicts, one per
+    changed run of lines, with the `op` ("replace", "delete" or
+    "insert"), the 1-based line where the change starts in `old` and
+    `new`, and the `old` and `new` lines.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [{
+        "op": tag,
+        "old_start": i1 + 1,
+        "old": old_lines[i1:i2],
+        "new_start": j1 + 1,
+        "new": new_lines[j1:j2]
+    } for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
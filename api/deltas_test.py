@@ -0,0 +1,41 @@
+from .deltas import apply_delta, make_delta, structured_diff, unified_diff
+
+
+def test_delta_round_trip():
+    old = "# Title\n\nFirst paragraph.\n\nSecond paragraph.\n"
+    new = "# New title\n\nFirst paragraph.\n\nSecond paragraph.\nThird."
+    assert apply_delta(old, make_delta(old, new)) == new
+    assert apply_delta(new, make_delta(new, old)) == old
+
+
+def test_delta_edge_cases():
+    assert apply_delta("", make_delta("", "text")) == "text"
+    assert apply_delta("text", make_delta("text", "")) == ""
+    assert apply_delta("a\r\nb", make_delta("a\r\nb", "a\r\nc")) == "a\r\nc"
+
+
+def test_delta_is_smaller_than_body():
+    old = "".join(f"Line number {i} of a long page.\n" for i in range(1000))
+    new = old.replace("Line number 500 ", "Line 500 ")
+    assert len(make_delta(old, new)) < len(new) / 100
+
+
+def test_diffs():
+    old = "a\nb\nc\n"
+    new = "a\nB\nc\nd\n"
+    assert unified_diff(old, new, "1", "2").splitlines()[:3] == [
+        "--- 1", "+++ 2", "@@ -1,3 +1,4 @@"
+    ]
+    assert structured_diff(old, new) == [{
+        "op": "replace",
+        "old_start": 2,
+        "old": ["b\n"],
+        "new_start": 2,
+        "new": ["B\n"]
+    }, {
+        "op": "insert",
+        "old_start": 4,
+        "old": [],
+        "new_start": 4,
+        "new": ["d\n"]
+    }]
@@ -0,0 +1,241 @@
+"""
+How responses are encoded: a faster JSON provider, and gzip, zstd or
+brotli compression negotiated with Accept-Encoding.
+
+zstd and brotli are used when the `zstandard` and `brotli` packages are
+installed, and JSON is encoded with `orjson` when it is.
+"""
+import json
+import zlib
+
+from flask import Response, current_app, g, request
+from flask.json.provider import DefaultJSONProvider, _default
+
+from .cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {"application/json", "text/html", "text/plain"}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider without sorting keys or escaping non-ASCII
+    characters, reusing one encoder rather than building one per call.
+    Dates are still encoded the way Flask encodes them.
+    """
+    sort_keys = False
+    ensure_ascii = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._encoder = json.JSONEncoder(default=self.default,
+                                         ensure_ascii=False,
+                                         separators=(",", ":"))
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        if orjson is not None and self.default is _default:
+            return orjson.dumps(
+                obj, default=_default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+        return self._encoder.encode(obj)
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None
+                                     and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(f"{self.dumps(obj)}\n",
+                                        mimetype=self.mimetype)
+
+
+def gzip_compressor(level=6):
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+class Codec:
+    """
+    A content coding: `compress(data)` compresses a whole body and
+    `compressor()` returns an object with `compress(chunk)` and `flush()`
+    for streamed ones.
+    """
+
+    def __init__(self, compress, compressor):
+        self.compress = compress
+        self.compressor = compressor
+
+
+CODECS = {"gzip": Codec(lambda data: zlib.compress(data, 6, 31),
+                        gzip_compressor)}
+if zstandard is not None:
+    CODECS["zstd"] = Codec(
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda: zstandard.ZstdCompressor(level=3).compressobj())
+if brotli is not None:
+    CODECS["br"] = Codec(lambda data: brotli.compress(data, quality=4),
+                         lambda: BrotliCompressor(quality=4))
+
+
+class BrotliCompressor:
+    """Give brotli's streaming compressor the zlib method names."""
+
+    def __init__(self, **kwargs):
+        self._compressor = brotli.Compressor(**kwargs)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class Compressor:
+    """
+    Compresses responses of at least `min_size` bytes with the best
+    coding the client accepts, from `encodings` in order of preference.
+    Streamed responses are compressed chunk by chunk whatever their size,
+    since the size is not known up front.
+
+    `cache` holds compressed bodies of responses whose content is fixed
+    by a key, such as a URL and a strong ETag, so that they need neither
+    serializing nor compressing again.
+
+    A compressed response's ETag gets the coding as a suffix, as the
+    bytes differ from the uncompressed ones; `match_etag` accepts any of
+    the suffixed forms wherever a client sends an ETag back.
+    """
+
+    def __init__(self, min_size=1024, encodings=("zstd", "br", "gzip"),
+                 cache_size=256):
+        self.min_size = min_size
+        self.encodings = [name for name in encodings if name in CODECS]
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def negotiate(self, accept_encodings):
+        return accept_encodings.best_match(self.encodings)
+
+    def compress_response(self, response, encoding):
+        if not self.is_compressible(response):
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(
+                response.response, CODECS[encoding].compressor())
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            response.set_data(CODECS[encoding].compress(body))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def is_compressible(self, response):
+        return (response.status_code == 200
+                and response.mimetype in COMPRESSIBLE_TYPES
+                and 'Content-Encoding' not in response.headers
+                and not response.direct_passthrough)
+
+    def cached_response(self, key):
+        """
+        Return the cached compressed response for `key`, in the coding
+        negotiated for this request, or None. If there is none, the
+        response to this request will be cached under `key`.
+        """
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None:
+            return None
+        cached = self.cache.get((key, encoding))
+        if cached is None:
+            g.compression_cache_key = (key, encoding)
+            return None
+        body, mimetype = cached
+        response = Response(body, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def compress_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def get_compressor(app=None):
+    app = app or current_app
+    return app.extensions['compressor']
+
+
+def coded_etags(etag):
+    """
+    Return the forms `etag` is sent in: as it is for uncompressed bodies
+    and with a suffix for each coding.
+    """
+    return [etag] + [f"{etag}-{name}" for name in CODECS]
+
+
+def match_etag(etags, etag, weak=False):
+    """
+    Return the form of `etag` that matches `etags`, the ETags of an
+    If-Match or If-None-Match header, or None if none does.
+    """
+    contains = etags.contains_weak if weak else etags.contains
+    return next((tag for tag in coded_etags(etag) if contains(tag)), None)
+
+
+def compress_response(response):
+    if request.method != "HEAD" and 'Content-Encoding' not in response.headers:
+        response = negotiate_and_compress(response)
+    # compressed responses from the cache get their ETag only now
+    encoding = response.headers.get('Content-Encoding')
+    etag, weak = response.get_etag()
+    if etag and encoding in CODECS and not etag.endswith(f"-{encoding}"):
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def negotiate_and_compress(response):
+    compressor = get_compressor()
+    encoding = compressor.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    response = compressor.compress_response(response, encoding)
+    key = g.get('compression_cache_key')
+    if (key is not None and key[1] == encoding
+            and response.headers.get('Content-Encoding') == encoding):
+        compressor.cache.set(key, (response.get_data(), response.mimetype))
+    return response
+
+
+def init_app(app):
+    app.json = FastJSONProvider(app)
+    app.extensions['compressor'] = Compressor(
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        encodings=app.config['COMPRESS_ENCODINGS'],
+        cache_size=app.config['COMPRESS_CACHE_SIZE'])
+    # registered before the blueprints, so that it runs after their hooks
+    app.after_request(compress_response)
@@ -0,0 +1,76 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+from .app import create_app
+from .data import Page
+from .db import get_db
+from .encoding import get_compressor
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({"DATABASE": tmp_path / "test.sqlite3"})
+    with app.app_context():
+        Page.create_with_body(get_db(), title="Home", body="Hello " * 500)
+        Page.create_with_body(get_db(), title="Short", body="Hi")
+    return app
+
+
+def test_json_is_compact_and_keeps_dates(app):
+    with app.app_context():
+        dumps = app.json.dumps
+        assert dumps({"b": 1, "a": "é"}) == '{"b":1,"a":"é"}'
+        assert dumps(datetime(2024, 1, 2)) == \
+            '"Tue, 02 Jan 2024 00:00:00 GMT"'
+
+
+def test_large_responses_are_compressed(app, make_client):
+    client = make_client(app)
+    plain = client.get("/pages/Home/")
+    assert "Content-Encoding" not in plain.headers
+
+    response = client.get("/pages/Home/",
+                          headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+    assert json.loads(gzip.decompress(response.data)) == plain.json
+
+    # either form of the ETag shows the page is unchanged
+    for etag in (plain.headers["ETag"], response.headers["ETag"]):
+        not_modified = client.get("/pages/Home/",
+                                  headers={
+                                      "Accept-Encoding": "gzip",
+                                      "If-None-Match": etag
+                                  })
+        assert not_modified.status_code == 304
+        assert not_modified.headers["ETag"] == etag
+
+    short = client.get("/pages/Short/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in short.headers
+
+
+def test_compressed_details_are_cached(app, make_client):
+    client = make_client(app)
+    cache = get_compressor(app).cache
+    first = client.get("/pages/Home/", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/pages/Home/", headers={"Accept-Encoding": "gzip"})
+    assert cache.stats()["hits"] == 1
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+    with app.app_context():
+        Page.get_by_title(get_db(), "Home").add_version(get_db(), "Bye")
+    third = client.get("/pages/Home/", headers={"Accept-Encoding": "gzip"})
+    assert json.loads(gzip.decompress(third.data))["body"] == "Bye"
+
+
+def test_streamed_list_is_compressed(app, make_client):
+    response = make_client(app).get("/pages/",
+                                    headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    pages = json.loads(gzip.decompress(response.data))["pages"]
+    assert [page["title"] for page in pages] == ["Home", "Short"]
@@ -0,0 +1,75 @@
+import json
+from itertools import islice
+from pathlib import Path
+
+from .data import Page, PageVersion, UnitOfWork
+
+
+def read_markdown_dir(path):
+    """
+    Yield (title, body) pairs from the `.md` files in a directory. The
+    first line of each file is the title and the rest is the body.
+    """
+    for page_path in sorted(Path(path).glob("*.md")):
+        with open(page_path, 'r') as file:
+            title = file.readline().strip()
+            body = file.read().strip()
+        yield title, body
+
+
+def read_ndjson(path):
+    """
+    Yield (title, body) pairs from a file with one JSON object per line,
+    each with a `title` and a `body`.
+    """
+    with open(path, 'r') as file:
+        for line in file:
+            if line.strip():
+                page = json.loads(line)
+                yield page.get('title'), page.get('body')
+
+
+def read_pages(path):
+    if Path(path).is_dir():
+        return read_markdown_dir(path)
+    return read_ndjson(path)
+
+
+def import_pages(db, path, batch_size=500, user_id=None):
+    """
+    Import pages from a directory of `.md` files or an NDJSON file,
+    reading and saving `batch_size` pages at a time with
+    `DBObject.save_many`, each batch in one transaction so that an
+    import that fails leaves no page without a body. Pages without a
+    body or whose title already exists are skipped. `db` must be a
+    pooled connection outside of a request.
+
+    Returns a tuple of the number of pages imported and skipped.
+    """
+    pages = read_pages(path)
+    imported = skipped = 0
+    while True:
+        batch = list(islice(pages, batch_size))
+        if not batch:
+            return imported, skipped
+
+        bodies = {Page(title=title): body for title, body in batch if body}
+        # the unit of work keeps the models from committing each step
+        unit_of_work = db.unit_of_work = UnitOfWork()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            saved = Page.save_many(db, list(bodies))
+            PageVersion.save_many(db, [
+                PageVersion(page_id=page.id,
+                            body=bodies[page],
+                            user_id=user_id) for page in saved
+            ])
+        except Exception:
+            unit_of_work.rollback(db)
+            raise
+        else:
+            unit_of_work.commit(db)
+        finally:
+            db.unit_of_work = None
+        imported += len(saved)
+        skipped += len(batch) - len(saved)
@@ -0,0 +1,62 @@
+import json
+import sqlite3
+
+import pytest
+
+from .data import Change, Link, Page, PageSearch, PageVersion
+from .db import Connection
+from .importer import import_pages
+
+
+@pytest.fixture
+def db():
+    db = sqlite3.connect(":memory:", factory=Connection)
+    Page.create_table(db)
+    PageVersion.create_table(db)
+    PageSearch.create_table(db)
+    Link.create_table(db)
+    Change.create_table(db)
+    return db
+
+
+def test_import_markdown_dir(db, tmp_path):
+    (tmp_path / "one.md").write_text("One\n\nFirst page.\n")
+    (tmp_path / "two.md").write_text("Two\n\nSecond page.\n")
+    (tmp_path / "empty.md").write_text("Empty\n")
+
+    assert import_pages(db, tmp_path, batch_size=2) == (2, 1)
+    page = Page.get_by_title(db, "Two").with_history(db)
+    assert page.to_dict()["body"] == "Second page."
+
+
+def test_import_ndjson(db, tmp_path):
+    dump = tmp_path / "dump.ndjson"
+    pages = [{
+        "title": f"Page {number}",
+        "body": f"Body {number}"
+    } for number in [1, 2, 3, 1]]
+    # a title taken by an endpoint is skipped like a duplicate
+    pages.append({"title": "broken-links", "body": "Hidden"})
+    dump.write_text("\n".join(json.dumps(page) for page in pages))
+
+    assert import_pages(db, dump, batch_size=3) == (3, 2)
+    assert len(Page.select(db)) == 3
+    assert PageSearch.search(db, "Body 3")[0].title == "Page 3"
+
+
+def test_failed_batch_is_rolled_back(db, tmp_path, monkeypatch):
+    (tmp_path / "one.md").write_text("One\n\nFirst page.\n")
+
+    def fail(db, versions):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(PageVersion, "save_many", fail)
+        with pytest.raises(sqlite3.OperationalError):
+            import_pages(db, tmp_path)
+    assert Page.select(db) == []
+    assert Change.since(db)[0] == []
+
+    assert import_pages(db, tmp_path) == (1, 0)
+    assert Page.get_by_title(db, "One").with_history(db).to_dict()["body"] \
+        == "First page."
@@ -0,0 +1,367 @@
+import bisect
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from flask import Blueprint, Response, current_app, g, request
+
+bp = Blueprint('metrics', __name__)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+MAX_STATEMENTS = 1000
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """
+    Collapse whitespace and lists of placeholders so that the same
+    statement is always reported the same way.
+    """
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return re.sub(r"\?(?:, \?)+", "?, ...", sql)
+
+
+class QueryLog:
+    """
+    The SQL statements run on a connection during one request: how
+    many, how long they took, how many rows they returned and the
+    slowest few of them.
+    """
+
+    def __init__(self, keep_slowest=5):
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+        self.statements = {}
+
+    def record(self, sql, elapsed):
+        self.count += 1
+        self.add_time(sql, elapsed)
+
+    def add_time(self, sql, elapsed):
+        self.time += elapsed
+        self.statements[sql] = self.statements.get(sql, 0.0) + elapsed
+
+    def finish(self):
+        """
+        Work out the slowest statements once the request is done.
+        """
+        self.slowest = sorted(((elapsed, normalize_sql(sql))
+                               for sql, elapsed in self.statements.items()),
+                              reverse=True)[:self.keep_slowest]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor that records the time spent executing statements and
+    fetching rows, and the number of rows fetched, in the `query_log`
+    of its connection, if it has one.
+    """
+
+    def execute(self, sql, parameters=()):
+        log = self.connection.query_log
+        if log is None:
+            return super().execute(sql, parameters)
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            log.record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        log = self.connection.query_log
+        if log is None:
+            return super().executemany(sql, seq_of_parameters)
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            log.record(sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone, single=True)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._timed_fetch(lambda: super(InstrumentedCursor, self).
+                                 fetchmany(size))
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def __next__(self):
+        row = super().__next__()
+        log = self.connection.query_log
+        if log is not None:
+            log.rows += 1
+        return row
+
+    def _timed_fetch(self, fetch, single=False):
+        log = self.connection.query_log
+        if log is None:
+            return fetch()
+        started = time.perf_counter()
+        result = fetch()
+        log.add_time(getattr(self, "sql", ""), time.perf_counter() - started)
+        if single:
+            log.rows += result is not None
+        else:
+            log.rows += len(result)
+        return result
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A connection whose cursors are InstrumentedCursors. Set its
+    `query_log` to a QueryLog to start recording.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_log = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf", ), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """
+    Process-wide request and SQL metrics, rendered in the Prometheus
+    text format by `to_prometheus`.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.request_latency = {}
+        self.sql = {}
+        self.queries_per_request = {}
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, endpoint, method, status, elapsed, log):
+        key = (endpoint, method)
+        with self._lock:
+            status_key = key + (status, )
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.request_latency.setdefault(
+                key, Histogram(REQUEST_BUCKETS)).observe(elapsed)
+            if log is None:
+                return
+
+            self.queries_per_request.setdefault(
+                endpoint, Histogram(QUERY_COUNT_BUCKETS)).observe(log.count)
+            totals = self.sql.setdefault(endpoint, [0, 0.0, 0])
+            totals[0] += log.count
+            totals[1] += log.time
+            totals[2] += log.rows
+            for sql, elapsed in log.statements.items():
+                sql = normalize_sql(sql)
+                stats = self.statements.get(sql)
+                if stats is None:
+                    if len(self.statements) >= MAX_STATEMENTS:
+                        continue
+                    stats = self.statements[sql] = [0.0, 0.0]
+                stats[0] += elapsed
+                stats[1] = max(stats[1], elapsed)
+
+    def to_prometheus(self, gauges=(), counters=(), top_statements=20):
+        """
+        Render the metrics in the Prometheus text format, followed by
+        `gauges` and `counters`, lists of (name, help text, samples) where
+        the samples are (labels, value) pairs.
+        """
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, hist):
+            for bound, total in hist.cumulative_counts():
+                lines.append(
+                    f"{name}_bucket{labels_text(labels, le=bound)} {total}")
+            lines.append(f"{name}_sum{labels_text(labels)} {hist.sum}")
+            lines.append(f"{name}_count{labels_text(labels)} {hist.count}")
+
+        with self._lock:
+            header("wiki_http_requests_total", "counter",
+                   "HTTP requests by endpoint, method and status.")
+            for (endpoint, method, status), count in self.requests.items():
+                labels = dict(endpoint=endpoint, method=method, status=status)
+                lines.append(
+                    f"wiki_http_requests_total{labels_text(labels)} {count}")
+
+            header("wiki_http_request_duration_seconds", "histogram",
+                   "HTTP request latency by endpoint and method.")
+            for (endpoint, method), hist in self.request_latency.items():
+                histogram("wiki_http_request_duration_seconds",
+                          dict(endpoint=endpoint, method=method), hist)
+
+            header("wiki_sql_queries_per_request", "histogram",
+                   "SQL statements run per request by endpoint.")
+            for endpoint, hist in self.queries_per_request.items():
+                histogram("wiki_sql_queries_per_request",
+                          dict(endpoint=endpoint), hist)
+
+            for index, (name, help_text) in enumerate([
+                ("wiki_sql_queries_total", "SQL statements run by endpoint."),
+                ("wiki_sql_seconds_total", "Time spent in SQL by endpoint."),
+                ("wiki_sql_rows_total", "Rows fetched by endpoint.")
+            ]):
+                header(name, "counter", help_text)
+                for endpoint, totals in self.sql.items():
+                    lines.append(f"{name}{labels_text(dict(endpoint=endpoint))}"
+                                 f" {totals[index]}")
+
+            slowest = sorted(self.statements.items(),
+                             key=lambda item: item[1][0],
+                             reverse=True)[:top_statements]
+            header("wiki_sql_statement_seconds_total", "counter",
+                   f"Time spent in the {top_statements} costliest statements.")
+            for sql, (total, _) in slowest:
+                lines.append("wiki_sql_statement_seconds_total"
+                             f"{labels_text(dict(statement=sql))} {total}")
+            header("wiki_sql_statement_max_seconds", "gauge",
+                   "Longest time one request spent in a statement.")
+            for sql, (_, longest) in slowest:
+                lines.append("wiki_sql_statement_max_seconds"
+                             f"{labels_text(dict(statement=sql))} {longest}")
+
+        for kind, metrics in [("gauge", gauges), ("counter", counters)]:
+            for name, help_text, values in metrics:
+                header(name, kind, help_text)
+                for labels, value in values:
+                    lines.append(f"{name}{labels_text(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def labels_text(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n") for value in labels.values())
+    return "{" + ",".join(
+        f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def get_metrics(app=None):
+    app = app or current_app
+    return app.extensions.setdefault('metrics', Metrics())
+
+
+@bp.before_app_request
+def start_request():
+    g.request_started = time.perf_counter()
+    g.query_log = QueryLog()
+
+
+@bp.after_app_request
+def finish_request(response):
+    started = g.get('request_started')
+    log = g.get('query_log')
+    if started is None:
+        return response
+
+    if current_app.config['SERVER_TIMING'] and log is not None:
+        elapsed = time.perf_counter() - started
+        response.headers['Server-Timing'] = (
+            f'sql;dur={log.time * 1000:.2f};desc="{log.count} queries", '
+            f'app;dur={elapsed * 1000:.2f}')
+
+    # Streamed responses are still running queries at this point, so the
+    # metrics are recorded once the response is closed.
+    metrics = get_metrics()
+    endpoint = request.endpoint or "none"
+    method = request.method
+    status = response.status_code
+
+    def record():
+        if log is not None:
+            log.finish()
+        metrics.record_request(endpoint, method, status,
+                               time.perf_counter() - started, log)
+
+    response.call_on_close(record)
+    return response
+
+
+@bp.route("/metrics")
+def metrics():
+    from .data import Page, PageVersion, User
+    from .db import get_pool
+    from .encoding import get_compressor
+
+    pool = get_pool().stats()
+    caches = [("token", User.token_cache.stats()),
+              ("render", Page.render_cache.stats()),
+              ("diff", PageVersion.diff_cache.stats()),
+              ("compressed", get_compressor().cache.stats())]
+    gauges = [
+        ("wiki_db_pool_connections", "Open database connections.",
+         [({}, pool["connections"])]),
+        ("wiki_db_pool_max_wait_seconds",
+         "Longest wait for a connection.", [({}, pool["max_wait_time"])]),
+        ("wiki_cache_size", "Cache entries.",
+         [(dict(cache=name), stats["size"]) for name, stats in caches]),
+    ]
+    counters = [
+        ("wiki_db_pool_checkouts_total",
+         "Connections checked out of the pool.", [({}, pool["checkouts"])]),
+        ("wiki_db_pool_wait_seconds_total",
+         "Time spent waiting for a connection.", [({}, pool["wait_time"])]),
+    ] + [(f"wiki_cache_{stat}_total", f"Cache {stat}.",
+          [(dict(cache=name), stats[stat]) for name, stats in caches])
+         for stat in ["hits", "misses"]]
+    limited = current_app.extensions['auth_limits'].stats()
+    counters.append(("wiki_auth_rejected_total",
+                     "Password requests turned away with a 429.",
+                     [(dict(reason=reason), count)
+                      for reason, count in limited.items()]))
+    writer = current_app.extensions.get('db_writer')
+    if writer is not None:
+        stats = writer.stats()
+        counters += [
+            ("wiki_db_writer_batches_total",
+             "Group commits by the writer thread.", [({}, stats["batches"])]),
+            ("wiki_db_writer_jobs_total",
+             "Writes committed by the writer thread.", [({}, stats["jobs"])]),
+        ]
+
+    return Response(get_metrics().to_prometheus(gauges, counters),
+                    mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,53 @@
+import sqlite3
+
+from .metrics import (Histogram, InstrumentedConnection, Metrics, QueryLog,
+                      labels_text, normalize_sql)
+
+
+def test_query_log_records_statements_and_rows():
+    db = sqlite3.connect(":memory:", factory=InstrumentedConnection)
+    db.execute("CREATE TABLE things (name TEXT)")
+    db.query_log = QueryLog()
+    db.executemany("INSERT INTO things VALUES (?)", [("a", ), ("b", ), ("c", )])
+    assert len(db.execute("SELECT * FROM things").fetchall()) == 3
+    assert db.execute("SELECT * FROM things").fetchone() == ("a", )
+    assert len(list(db.execute("SELECT * FROM things"))) == 3
+
+    log = db.query_log
+    log.finish()
+    assert log.count == 4
+    assert log.rows == 7
+    assert len(log.slowest) == 2
+    assert log.time >= 0
+
+
+def test_statements_are_normalized():
+    assert normalize_sql("SELECT *\n  FROM things WHERE id IN (?, ?, ?)") == \
+        "SELECT * FROM things WHERE id IN (?, ...)"
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram((1, 5))
+    for value in [0.5, 1, 3, 10]:
+        hist.observe(value)
+    assert list(hist.cumulative_counts()) == [(1, 2), (5, 3), ("+Inf", 4)]
+
+
+def test_prometheus_output():
+    metrics = Metrics()
+    log = QueryLog()
+    log.record("SELECT 1", 0.25)
+    metrics.record_request("pages.page_list", "GET", 200, 0.5, log)
+
+    text = metrics.to_prometheus(
+        gauges=[("wiki_cache_size", "Cache entries.", [({}, 3)])],
+        counters=[("wiki_cache_hits_total", "Cache hits.", [({}, 7)])])
+    assert ('wiki_http_requests_total{endpoint="pages.page_list",'
+            'method="GET",status="200"} 1') in text
+    assert 'wiki_sql_queries_total{endpoint="pages.page_list"} 1' in text
+    assert ('wiki_sql_statement_seconds_total{statement="SELECT 1"} 0.25'
+            in text)
+    assert "# TYPE wiki_cache_size gauge\nwiki_cache_size 3" in text
+    assert ("# TYPE wiki_cache_hits_total counter\nwiki_cache_hits_total 7"
+            in text)
+    assert labels_text({"a": 'say "hi"\n'}) == '{a="say \\"hi\\"\\n"}'
@@ -0,0 +1,159 @@
+"""
+Versioned schema migrations.
+
+Each migration is a function that takes a connection, listed in
+`MIGRATIONS` with its version number. `upgrade` runs the ones that have
+not been applied yet, in order, each in its own transaction, and records
+them in the `schema_migrations` table.
+"""
+from datetime import datetime
+
+from .data import (Change, Link, Page, PageSearch, PageVersion, UnitOfWork,
+                   User)
+from .metrics import QueryLog, normalize_sql
+
+TABLE = "schema_migrations"
+
+
+def create_tables(db):
+    """Create the model tables."""
+    Page.create_table(db)
+    PageVersion.create_table(db)
+    User.create_table(db)
+    PageSearch.create_table(db)
+    Link.create_table(db)
+
+
+def index_page_history(db):
+    """
+    Index page versions by page and time for full history and latest
+    version lookups, and by page and id for paginated history and the
+    delta chains.
+    """
+    db.execute("CREATE INDEX IF NOT EXISTS page_versions_page_id_saved_at "
+               "ON page_versions (page_id, saved_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS page_versions_page_id "
+               "ON page_versions (page_id)")
+
+
+def index_user_tokens(db):
+    """Index users by token for token authentication."""
+    db.execute("CREATE INDEX IF NOT EXISTS users_token ON users (token)")
+
+
+def create_change_log(db):
+    """Create the change log, starting from the latest versions."""
+    Change.create_table(db)
+
+
+MIGRATIONS = [
+    (1, create_tables),
+    (2, index_page_history),
+    (3, index_user_tokens),
+    (4, create_change_log),
+]
+
+
+def applied_versions(db):
+    with db:
+        db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP
+        )""")
+    return {row[0] for row in db.execute(f"SELECT version FROM {TABLE}")}
+
+
+def pending(db):
+    applied = applied_versions(db)
+    return [(version, migration) for version, migration in MIGRATIONS
+            if version not in applied]
+
+
+def upgrade(db):
+    """
+    Apply the pending migrations and return their versions. `db` must be
+    a pooled connection.
+
+    Each migration starts with BEGIN IMMEDIATE and holds the write lock
+    until it commits, with a unit of work keeping the models' `with db:`
+    blocks from committing early. Whether it has been applied is checked
+    again under the lock, so that processes starting together apply
+    each migration once between them.
+    """
+    versions = []
+    for version, migration in pending(db):
+        previous, db.unit_of_work = db.unit_of_work, UnitOfWork()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version not in applied_versions(db):
+                migration(db)
+                db.execute(
+                    f"INSERT INTO {TABLE} (version, name, applied_at) "
+                    "VALUES (?, ?, ?)", [version, migration.__name__,
+                                         datetime.now()])
+                versions.append(version)
+        except Exception:
+            db.unit_of_work.rollback(db)
+            raise
+        else:
+            db.unit_of_work.commit(db)
+        finally:
+            db.unit_of_work = previous
+    return versions
+
+
+def model_queries(db):
+    """
+    Yield the names of the hot model queries, each with a function that
+    runs it against the first page and user in the database.
+    """
+    page = next(Page.iter_select(db, "ORDER BY id LIMIT 1"), None)
+    user = next(User.iter_select(db, "ORDER BY id LIMIT 1"), None)
+    if page is not None:
+        fragment, params = Page.keyset_fragment(limit=100)
+        yield "page list stamps", lambda: Page.version_stamps(
+            db, fragment, params)
+        yield "page list", lambda: list(
+            Page.iter_with_latest_version(db, fragment, params))
+        yield "page detail stamps", lambda: Page.version_stamps(
+            db, "WHERE title = ?", [page.title], count_versions=True)
+        yield "page by title", lambda: Page.get_by_title(db, page.title)
+        yield "page history", lambda: page.with_history(db)
+        yield "page history page", lambda: page.with_history(db, limit=10)
+        yield "new version", lambda: PageVersion(page_id=page.id,
+                                                 body="").make_delta(db)
+        yield "backlinks", lambda: Link.backlinks(db, page.title)
+        yield "broken links", lambda: Link.broken(db, limit=100)
+        yield "search", lambda: PageSearch.search(db, page.title, limit=10)
+    if user is not None:
+        yield "user by token", lambda: User.get_by_token(db, user.token)
+        yield "user by username", lambda: User.get_by_username(
+            db, user.username)
+
+
+def query_plans(db):
+    """
+    Run the model queries and return a list of (name, sql, plan) for
+    every statement they ran, where `plan` is the list of
+    EXPLAIN QUERY PLAN lines, indented to show their nesting.
+    """
+    plans = []
+    for name, run in model_queries(db):
+        db.query_log = QueryLog()
+        try:
+            run()
+            statements = list(db.query_log.statements)
+        finally:
+            db.query_log = None
+        for sql in statements:
+            params = [None] * sql.count("?")
+            depths = {0: -1}
+            lines = []
+            for id, parent, _, detail in db.execute(
+                    f"EXPLAIN QUERY PLAN {sql}", params):
+                depths[id] = depths.get(parent, -1) + 1
+                lines.append("  " * depths[id] + detail)
+            plans.append((name, normalize_sql(sql), lines))
+    return plans
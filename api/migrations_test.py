@@ -0,0 +1,40 @@
+import sqlite3
+
+from . import migrations
+from .db import Connection
+from .migrations import MIGRATIONS, upgrade
+
+
+def test_upgrade_applies_pending_migrations_once():
+    db = sqlite3.connect(":memory:", factory=Connection)
+    assert upgrade(db) == [version for version, _ in MIGRATIONS]
+    assert upgrade(db) == []
+
+    indexes = {
+        row[0]
+        for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert {"page_versions_page_id_saved_at", "users_token"} <= indexes
+    plan = db.execute("EXPLAIN QUERY PLAN SELECT * FROM users WHERE token = ?",
+                      ["x"]).fetchall()
+    assert "users_token" in plan[0][3]
+
+
+def test_upgrade_skips_migrations_applied_meanwhile(tmp_path, monkeypatch):
+    path = tmp_path / "test.sqlite3"
+    db = sqlite3.connect(path, factory=Connection)
+    other = sqlite3.connect(path, factory=Connection)
+    pending = migrations.pending
+
+    def apply_elsewhere_first(db):
+        # another process starting at the same time gets the lock first
+        found = pending(db)
+        monkeypatch.setattr(migrations, "pending", pending)
+        upgrade(other)
+        return found
+
+    monkeypatch.setattr(migrations, "pending", apply_elsewhere_first)
+    assert upgrade(db) == []
+    assert db.execute("SELECT count(*) FROM schema_migrations").fetchone() \
+        == (len(MIGRATIONS),)
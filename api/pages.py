@@ -1,11 +1,53 @@
-from flask import Blueprint, request, g
+import hashlib
+import math
+import time
+from datetime import datetime, timezone
 
-from .data import Page
-from .db import get_db
+from flask import (Blueprint, Response, current_app, g, make_response,
+                   request, stream_with_context)
+
+from .cache import LRUCache
+from .data import Change, Link, Page, PageSearch, PageVersion, begin_write
+from .render import RenderCache
+from .db import close_db, get_db, get_pool, keep_db_until_closed, run_write
+from .encoding import get_compressor, match_etag
 from .auth import login_required
 
 bp = Blueprint('pages', __name__, url_prefix='/pages')
 
+VERSION_FIELDS = {"body", "updated_at", "updated_by"}
+
+
+@bp.record_once
+def configure_render_cache(state):
+    Page.render_cache = RenderCache(
+        maxsize=state.app.config['RENDER_CACHE_SIZE'])
+
+
+@bp.record_once
+def configure_diff_cache(state):
+    PageVersion.diff_cache = LRUCache(
+        maxsize=state.app.config['DIFF_CACHE_SIZE'])
+
+
+def pagination_args():
+    """
+    Read the `after`, `limit` and `fields` query parameters. `limit`
+    defaults to the PAGE_SIZE config value and is capped at MAX_PAGE_SIZE;
+    either can be None for no limit.
+    `fields` is a comma-separated list of keys to include in each result.
+    """
+    after = request.args.get('after', type=int)
+    limit = request.args.get(
+        'limit', current_app.config['PAGE_SIZE'], type=int)
+    max_limit = current_app.config['MAX_PAGE_SIZE']
+    if limit is not None:
+        limit = max(1, limit if max_limit is None else min(limit, max_limit))
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = {field.strip() for field in fields.split(",")}
+    return after, limit, fields
+
 
 @bp.route("/", methods=['GET', 'POST'])
 def page_list():
@@ -13,55 +55,378 @@ def page_list():
 
     if request.method == 'POST':
         return create_page()
+
+    after, limit, fields = pagination_args()
+    sql_fragment, params = Page.keyset_fragment(after=after, limit=limit)
+    etag = list_etag(Page.version_stamps(db, sql_fragment, params))
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    if fields is None or fields & VERSION_FIELDS:
+        version_columns = None
+        if fields is not None and "body" not in fields:
+            version_columns = ["id", "page_id", "user_id", "saved_at"]
+        pages = Page.iter_with_latest_version(
+            db, sql_fragment, params, version_columns=version_columns)
     else:
-        return {
-            "pages": [
-                page.with_history(db).to_dict() for page in Page.select(db)
-            ]
-        }
+        pages = Page.iter_select(db, sql_fragment, params)
+
+    response = Response(
+        stream_with_context(stream_page_list(pages, limit, fields)),
+        mimetype="application/json")
+    return with_validators(keep_db_until_closed(response), etag)
+
+
+def stream_page_list(pages, limit, fields):
+    """
+    Yield the JSON for one page of the page list piece by piece, so
+    that only one batch of pages is held in memory. `pages` holds up to
+    one page more than `limit`, which tells us the `next` cursor.
+    """
+    dumps = current_app.json.dumps
+    next_after = None
+    yield '{"pages": ['
+    for count, page in enumerate(pages):
+        if count == limit:
+            next_after = last_id
+            break
+        yield ("," if count else "") + dumps(page.to_dict(fields=fields))
+        last_id = page.id
+    yield '], "next": ' + dumps(next_after) + '}'
+
+
+@bp.route("/search")
+def page_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return {"errors": [["q", "q is required"]]}, 422
+
+    _, limit, _ = pagination_args()
+    return {
+        "results": [{
+            **page.to_dict(), "snippet": page.snippet
+        } for page in PageSearch.search(get_db(), query, limit=limit)]
+    }
+
+
+@bp.route("/changes")
+def page_changes():
+    """
+    List the changes after the cursor `since`, oldest first, with the
+    cursor to pass next time. With `wait`, wait up to that many seconds
+    (at most CHANGES_MAX_WAIT) for a change if there is none yet. With
+    `Accept: text/event-stream`, stream the changes as server-sent
+    events instead, resuming from Last-Event-ID if given.
+    """
+    since = request.args.get('since', type=int)
+    _, limit, _ = pagination_args()
+    if request.accept_mimetypes.best == "text/event-stream":
+        since = request.headers.get('Last-Event-ID', since, type=int)
+        return Response(stream_changes(get_pool(), since, limit,
+                                       current_app.json.dumps),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+
+    wait = parse_wait(request.args.get('wait'),
+                      current_app.config['CHANGES_MAX_WAIT'])
+    # do not hold a connection while waiting
+    close_db()
+    changes, more = wait_for_changes(get_pool(), since, limit, wait)
+    return {
+        "changes": [change.to_dict() for change in changes],
+        "next": changes[-1].id if changes else since,
+        "more": more
+    }
+
+
+def parse_wait(value, max_wait):
+    """
+    Read a `wait` query parameter as a number of seconds from 0 to
+    `max_wait`. Anything else, including nan and infinities, is no wait.
+    """
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return 0
+    if not math.isfinite(wait):
+        return 0
+    return max(0, min(wait, max_wait))
+
+
+def wait_for_changes(pool, since, limit, wait, poll_interval=1.0):
+    """
+    Return the changes after `since` as soon as there are any, or no
+    changes after `wait` seconds. Commits in this process wake us up
+    at once; changes made by other processes are noticed every
+    `poll_interval` seconds.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        with pool.connection() as db:
+            changes, more = Change.since(db, since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes, more
+        Change.wait(min(remaining, poll_interval))
+
+
+def stream_changes(pool, since, limit, dumps, keepalive=15):
+    """
+    Yield server-sent events for the changes after `since`, forever,
+    with a comment every `keepalive` seconds without changes. This runs
+    outside the app context, so it is given the pool and `dumps`.
+    """
+    yield "retry: 1000\n\n"
+    while True:
+        changes, _ = wait_for_changes(pool, since, limit, keepalive)
+        if not changes:
+            yield ": keep-alive\n\n"
+        for change in changes:
+            yield (f"id: {change.id}\nevent: change\n"
+                   f"data: {dumps(change.to_dict())}\n\n")
+            since = change.id
+
+
+@bp.route("/broken-links/")
+def broken_links():
+    after, limit, _ = pagination_args()
+    links, next_after = Link.broken(get_db(), after=after, limit=limit)
+    return {
+        "broken_links": [link.to_dict() for link in links],
+        "next": next_after
+    }
+
+
+@bp.route("/<title>/backlinks/")
+def backlinks(title):
+    return {
+        "backlinks":
+        [page.to_dict() for page in Link.backlinks(get_db(), title)]
+    }
+
+
+@bp.route("/<title>/diff")
+def page_diff(title):
+    """
+    Show the diff between the versions `from` and `to` of a page, as a
+    unified diff, or as a list of changes with `format=structured`.
+    """
+    from_id = request.args.get('from', type=int)
+    to_id = request.args.get('to', type=int)
+    style = request.args.get('format', 'unified')
+    errors = [[name, f"{name} must be a version id"]
+              for name, value in [("from", from_id), ("to", to_id)]
+              if value is None]
+    if style not in ("unified", "structured"):
+        errors.append(["format", "format must be unified or structured"])
+    if errors:
+        return {"errors": errors}, 422
+
+    db = get_db()
+    page = Page.get_by_title(db, title)
+    diff = page and page.diff(db, from_id, to_id, style=style)
+    if diff is None:
+        return '', 404
+    return {"from": from_id, "to": to_id, "format": style, "diff": diff}
 
 
 @bp.route("/<title>/", methods=['GET', 'PUT', 'DELETE'])
 def page_detail(title):
     db = get_db()
-    page = Page.get_by_title(db, title)
-    if page:
-        if request.method == "PUT":
-            return update_page(page)
-        elif request.method == "DELETE":
-            return delete_page(page)
-        else:
-            return page.with_history(db).to_dict(all_history=True)
-    else:
+    stamps = Page.version_stamps(db,
+                                 "WHERE title = ?", [title],
+                                 count_versions=True)
+    if not stamps:
         return '', 404
 
+    etag, last_modified = page_validators(stamps[0])
+    conditional = (request.method == "GET"
+                   and request.args.get('format') != 'html')
+    if conditional and is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    # the stamp has every column of the page, so it need not be loaded again
+    page = Page.identify(db, Page(id=stamps[0].id, title=stamps[0].title))
+    if request.method == "PUT":
+        return update_page(page)
+    elif request.method == "DELETE":
+        return delete_page(page)
+    elif conditional:
+        # the ETag fixes the JSON, so its compressed form can be reused
+        response = get_compressor().cached_response(
+            (request.full_path, etag))
+        if response is None:
+            response = make_response(show_page(page))
+        return with_validators(response, etag, last_modified)
+    else:
+        return show_page(page)
+
+
+def page_validators(stamp):
+    """
+    Given a row from `Page.version_stamps`, return the strong ETag and
+    the Last-Modified time of the page's JSON representations. These only
+    change when the page gets a new version or loses old ones.
+    """
+    etag = f"{stamp.id}-{stamp.version_id}-{stamp.version_count}"
+    last_modified = None
+    if stamp.saved_at:
+        last_modified = datetime.fromisoformat(str(
+            stamp.saved_at)).astimezone(timezone.utc)
+    return etag, last_modified
+
+
+def list_etag(stamps):
+    """
+    Return a strong ETag for one page of the page list, given the
+    `Page.version_stamps` of the pages on it. It changes when any of those
+    pages is renamed, deleted or gets a new version.
+    """
+    digest = hashlib.sha1()
+    for stamp in stamps:
+        digest.update(
+            f"{stamp.id}:{stamp.title}:{stamp.version_id}\n".encode())
+    return digest.hexdigest()
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Check If-None-Match, or If-Modified-Since if there is no
+    If-None-Match, against the current validators of a resource.
+    """
+    if request.if_none_match:
+        return match_etag(request.if_none_match, etag, weak=True) is not None
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(
+            microsecond=0) <= request.if_modified_since
+    return False
+
+
+def not_modified(etag, last_modified=None):
+    # answer with the form of the ETag the client has, compressed or not
+    etag = match_etag(request.if_none_match, etag, weak=True) or etag
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+def check_if_match(db, page, if_match):
+    """
+    Raise PreconditionFailed if `if_match`, the request's If-Match, is
+    given and does not match the current ETag of the page, so that
+    concurrent edits do not overwrite each other. The ETag is read under
+    the write lock, so no other edit can come in between the check and
+    the write that follows it.
+    """
+    if not if_match:
+        return
+    begin_write(db)
+    stamps = Page.version_stamps(db,
+                                 "WHERE id = ?", [page.id],
+                                 count_versions=True)
+    if not stamps or match_etag(if_match,
+                                page_validators(stamps[0])[0]) is None:
+        raise PreconditionFailed()
+
+
+def precondition_failed():
+    return {"errors": ["page has been changed since it was read"]}, 412
+
+
+def show_page(page):
+    """
+    Show a page with one page of its history. When `after` is given,
+    the history does not start at the newest version, so the keys
+    describing the newest version are left out.
+    """
+    after, limit, fields = pagination_args()
+    if request.args.get('format') == 'html':
+        return show_page_html(page, fields)
+    if fields is not None and not fields & (VERSION_FIELDS | {"history"}):
+        return page.to_dict(fields=fields)
+
+    page.with_history(get_db(), after=after, limit=limit)
+    retval = page.to_dict(all_history=True, fields=fields)
+    if after is not None:
+        for field in VERSION_FIELDS:
+            retval.pop(field, None)
+    if 'history' in retval:
+        retval['history_next'] = page.history_next
+    return retval
+
+
+def show_page_html(page, fields):
+    """
+    Show a page with its latest version rendered to HTML in `html`,
+    without its history.
+    """
+    html = page.with_history(get_db(), limit=1).to_html(get_db())
+    retval = page.to_dict(fields=fields)
+    retval['html'] = html
+    return retval
+
 
 @login_required
 def create_page():
     data = request.get_json()
-    db = get_db()
-    page = Page.create_with_body(
-        db, title=data.get('title'), body=data.get('body'))
+    page = run_write(lambda db: Page.create_with_body(
+        db, title=data.get('title'), body=data.get('body')))
     if page.errors:
         return ({"errors": page.errors}, 422)
     else:
-        return page.with_history(db).to_dict(), 201
+        return page.with_history(get_db(), limit=1).to_dict(), 201
 
 
 @login_required
 def update_page(page):
     data = request.get_json()
-    db = get_db()
-    if data.get('title'):
-        page.title = data.get('title')
-        page.save(db)
-    if data.get('body'):
-        page.add_version(db, data.get('body'), user_id=g.user.id)
+    user_id = g.user.id
+    if_match = request.if_match
+
+    def write(db):
+        check_if_match(db, page, if_match)
+        if data.get('title') and data.get('title') != page.title:
+            page.title = data.get('title')
+            if not page.save(db):
+                return False
+        if data.get('body'):
+            page.add_version(db, data.get('body'), user_id=user_id)
+        return True
 
-    return page.with_history(db).to_dict()
+    try:
+        if not run_write(write):
+            return {"errors": page.errors}, 422
+    except PreconditionFailed:
+        return precondition_failed()
+
+    # only the latest version is shown, and the ETag needs no bodies
+    db = get_db()
+    response = make_response(page.with_history(db, limit=1).to_dict())
+    stamps = Page.version_stamps(db,
+                                 "WHERE id = ?", [page.id],
+                                 count_versions=True)
+    return with_validators(response, *page_validators(stamps[0]))
 
 
 @login_required
 def delete_page(page):
-    page.delete(get_db())
+    if_match = request.if_match
+
+    def delete(db):
+        check_if_match(db, page, if_match)
+        page.delete(db)
+
+    try:
+        run_write(delete)
+    except PreconditionFailed:
+        return precondition_failed()
     return "", 204
@@ -0,0 +1,240 @@
+import time
+
+import pytest
+
+from . import pages
+from .app import create_app
+from .data import Page
+from .db import get_pool
+
+
+@pytest.fixture
+def client(tmp_path, make_client):
+    return make_client(
+        create_app({
+            "DATABASE": tmp_path / "test.sqlite3",
+            "PASSWORD_HASH_ITERATIONS": 1,
+            "PASSWORD_HASH_WORKERS": 0
+        }))
+
+
+@pytest.fixture
+def auth(client):
+    response = client.post("/auth/user/",
+                           json={
+                               "username": "alice",
+                               "password": "secret"
+                           })
+    headers = {"Authorization": f"Token {response.json['token']}"}
+    client.post("/pages/",
+                json={
+                    "title": "Home",
+                    "body": "Hello"
+                },
+                headers=headers)
+    return headers
+
+
+def test_new_page_reports_every_error(client, auth):
+    response = client.post("/pages/", json={"body": ""}, headers=auth)
+    assert response.status_code == 422
+    assert response.json["errors"] == [["title", "title is required"],
+                                       ["body", "page must contain a body"]]
+
+
+def test_unchanged_page_is_not_modified(client, auth):
+    response = client.get("/pages/Home/")
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    response = client.get("/pages/Home/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    response = client.get("/pages/Home/",
+                          headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = client.get("/pages/Home/", headers={"If-None-Match": '"old"'})
+    assert response.status_code == 200
+
+
+def test_edits_need_the_current_etag(client, auth):
+    etag = client.get("/pages/Home/").headers["ETag"]
+
+    response = client.put("/pages/Home/",
+                          json={"body": "Hello again"},
+                          headers={
+                              **auth, "If-Match": etag
+                          })
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert new_etag != etag
+    assert client.get("/pages/Home/").headers["ETag"] == new_etag
+
+    # a second edit based on the first read has lost the race
+    response = client.put("/pages/Home/",
+                          json={"body": "Hello there"},
+                          headers={
+                              **auth, "If-Match": etag
+                          })
+    assert response.status_code == 412
+    response = client.delete("/pages/Home/",
+                             headers={
+                                 **auth, "If-Match": etag
+                             })
+    assert response.status_code == 412
+    assert client.get("/pages/Home/").json["body"] == "Hello again"
+
+    response = client.delete("/pages/Home/",
+                             headers={
+                                 **auth, "If-Match": new_etag
+                             })
+    assert response.status_code == 204
+
+
+def test_edits_accept_the_etag_of_a_compressed_page(client, auth):
+    etag = client.get("/pages/Home/").headers["ETag"]
+    response = client.put("/pages/Home/",
+                          json={"body": "Hello again"},
+                          headers={
+                              **auth, "If-Match": etag[:-1] + '-gzip"'
+                          })
+    assert response.status_code == 200
+
+
+def test_etag_is_checked_under_the_write_lock(client, auth, monkeypatch):
+    etag = client.get("/pages/Home/").headers["ETag"]
+    check_if_match = pages.check_if_match
+
+    def edit_first(db, page, if_match):
+        # another edit commits after the request has read the page
+        with get_pool(client.application).connection() as other:
+            Page.get(other, page.id).add_version(other, "Edited")
+            other.commit()
+        check_if_match(db, page, if_match)
+
+    monkeypatch.setattr(pages, "check_if_match", edit_first)
+    response = client.put("/pages/Home/",
+                          json={"body": "Hello again"},
+                          headers={
+                              **auth, "If-Match": etag
+                          })
+    assert response.status_code == 412
+    assert client.get("/pages/Home/").json["body"] == "Edited"
+
+
+@pytest.mark.parametrize("wait", ["nan", "inf", "-inf", "-1", "soon"])
+def test_bad_waits_do_not_wait(client, wait):
+    started = time.monotonic()
+    response = client.get(f"/pages/changes?wait={wait}")
+    assert response.status_code == 200
+    assert time.monotonic() - started < 1
+
+
+def test_diff_between_versions(client, auth):
+    client.put("/pages/Home/", json={"body": "Hello again"}, headers=auth)
+    new, old = [version["id"]
+                for version in client.get("/pages/Home/").json["history"]]
+
+    response = client.get(f"/pages/Home/diff?from={old}&to={new}")
+    assert response.status_code == 200
+    assert response.json["format"] == "unified"
+    assert "-Hello\n\\ No newline at end of file\n+Hello again\n" \
+        in response.json["diff"]
+
+    response = client.get(
+        f"/pages/Home/diff?from={old}&to={new}&format=structured")
+    assert response.json["diff"] == [{
+        "op": "replace",
+        "old_start": 1,
+        "old": ["Hello"],
+        "new_start": 1,
+        "new": ["Hello again"]
+    }]
+
+
+def test_diff_needs_versions_of_the_page(client, auth):
+    response = client.get("/pages/Home/diff?from=x&format=html")
+    assert response.status_code == 422
+    assert response.json["errors"] == [
+        ["from", "from must be a version id"],
+        ["to", "to must be a version id"],
+        ["format", "format must be unified or structured"]
+    ]
+
+    client.post("/pages/",
+                json={
+                    "title": "Other",
+                    "body": "Elsewhere"
+                },
+                headers=auth)
+    home = client.get("/pages/Home/").json["history"][0]["id"]
+    other = client.get("/pages/Other/").json["history"][0]["id"]
+    response = client.get(f"/pages/Home/diff?from={home}&to={other}")
+    assert response.status_code == 404
+    response = client.get(f"/pages/Nowhere/diff?from={home}&to={home}")
+    assert response.status_code == 404
+
+
+def test_broken_links_and_backlinks(client, auth):
+    client.post("/pages/",
+                json={
+                    "title": "Languages",
+                    "body": "[[Home]] [[Ruby]] [[Python]]"
+                },
+                headers=auth)
+
+    response = client.get("/pages/broken-links/?limit=1")
+    links = response.json["broken_links"]
+    assert [link["target"] for link in links] == ["Ruby"]
+    assert links[0]["source"]["title"] == "Languages"
+    response = client.get(
+        f"/pages/broken-links/?limit=1&after={response.json['next']}")
+    assert [link["target"]
+            for link in response.json["broken_links"]] == ["Python"]
+    assert response.json["next"] is None
+
+    response = client.get("/pages/Home/backlinks/")
+    assert [page["title"]
+            for page in response.json["backlinks"]] == ["Languages"]
+    assert client.get("/pages/Ruby/backlinks/").json["backlinks"][0][
+        "url"] == "/pages/Languages/"
+    assert client.get("/pages/Languages/backlinks/").json["backlinks"] == []
+
+
+def test_endpoint_titles_are_reserved(client, auth):
+    response = client.post("/pages/",
+                           json={
+                               "title": "broken-links",
+                               "body": "Hidden"
+                           },
+                           headers=auth)
+    assert response.status_code == 422
+    assert response.json["errors"] == [["title", "title is reserved"]]
+    response = client.put("/pages/Home/",
+                          json={"title": "broken-links"},
+                          headers=auth)
+    assert response.status_code == 422
+
+
+def test_search(client, auth):
+    for title, body in [("Snakes", "pythons are large snakes"),
+                        ("Python", "a language named after the snakes")]:
+        client.post("/pages/",
+                    json={
+                        "title": title,
+                        "body": body
+                    },
+                    headers=auth)
+
+    assert client.get("/pages/search?q=%20").status_code == 422
+    assert client.get("/pages/search").json["errors"] == [[
+        "q", "q is required"
+    ]]
+
+    results = client.get("/pages/search?q=snakes").json["results"]
+    assert {result["title"] for result in results} == {"Snakes", "Python"}
+    assert "**snakes**" in results[0]["snippet"]
+    assert results[0]["url"] == f"/pages/{results[0]['title']}/"
+    results = client.get("/pages/search?q=snakes&limit=1").json["results"]
+    assert len(results) == 1
+    assert client.get("/pages/search?q=ruby").json["results"] == []
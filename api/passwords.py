@@ -1,20 +1,82 @@
-import hashlib, binascii, os
- 
+import hashlib, binascii, hmac, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor
+
+ALGORITHM = "pbkdf2_sha512"
+LEGACY_ITERATIONS = 100000
+
+settings = {"iterations": 100000}
+executor = None
+
+
+def configure(iterations=None, workers=None):
+    """
+    Set the number of PBKDF2 iterations used for new hashes and the
+    number of worker processes that compute them. With no workers,
+    hashes are computed on the calling thread. Workers are spawned rather
+    than forked, since the app runs threads.
+    """
+    global executor
+    if iterations is not None:
+        settings["iterations"] = iterations
+    if workers is not None:
+        if executor is not None:
+            executor.shutdown(wait=False)
+        executor = None
+        if workers > 0:
+            # forking a process that already runs threads can deadlock
+            executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def pbkdf2(password, salt, iterations):
+    pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
+                                  salt.encode('ascii'), iterations)
+    return binascii.hexlify(pwdhash).decode('ascii')
+
+
+def run_kdf(password, salt, iterations):
+    """Run PBKDF2 in the worker pool if there is one."""
+    if executor is None:
+        return pbkdf2(password, salt, iterations)
+    return executor.submit(pbkdf2, password, salt, iterations).result()
+
+
+def parse_hash(stored_password):
+    """
+    Split a stored password into (algorithm, iterations, salt, hash).
+    Hashes from before the algorithm and iterations were stored are a
+    64-character salt followed by the hash.
+    """
+    if "$" not in stored_password:
+        return (ALGORITHM, LEGACY_ITERATIONS, stored_password[:64],
+                stored_password[64:])
+    algorithm, iterations, salt, pwdhash = stored_password.split("$", 3)
+    return algorithm, int(iterations), salt, pwdhash
+
+
 def hash_password(password):
     """Hash a password for storing."""
-    salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), 
-                                salt, 100000)
-    pwdhash = binascii.hexlify(pwdhash)
-    return (salt + pwdhash).decode('ascii')
- 
+    salt = hashlib.sha256(os.urandom(60)).hexdigest()
+    iterations = settings["iterations"]
+    pwdhash = run_kdf(password, salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt}${pwdhash}"
+
+
 def verify_password(stored_password, provided_password):
     """Verify a stored password against one provided by user"""
-    salt = stored_password[:64]
-    stored_password = stored_password[64:]
-    pwdhash = hashlib.pbkdf2_hmac('sha512', 
-                                  provided_password.encode('utf-8'), 
-                                  salt.encode('ascii'), 
-                                  100000)
-    pwdhash = binascii.hexlify(pwdhash).decode('ascii')
-    return pwdhash == stored_password
+    algorithm, iterations, salt, pwdhash = parse_hash(stored_password)
+    if algorithm != ALGORITHM:
+        return False
+    return hmac.compare_digest(
+        run_kdf(provided_password, salt, iterations), pwdhash)
+
+
+def needs_rehash(stored_password):
+    """
+    Return True if a stored password is in the legacy format or was not
+    hashed with the current algorithm and number of iterations.
+    """
+    if "$" not in stored_password:
+        return True
+    algorithm, iterations, _, _ = parse_hash(stored_password)
+    return algorithm != ALGORITHM or iterations != settings["iterations"]
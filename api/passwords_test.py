@@ -0,0 +1,48 @@
+import os
+
+from . import passwords
+from .passwords import hash_password, needs_rehash, verify_password
+
+
+def test_hash_round_trip():
+    stored = hash_password("secret")
+    assert stored.startswith("pbkdf2_sha512$")
+    assert verify_password(stored, "secret")
+    assert not verify_password(stored, "wrong")
+
+
+def test_legacy_hashes_verify_and_need_rehash():
+    salt = "a" * 64
+    legacy = salt + passwords.pbkdf2("secret", salt, 100000)
+    assert verify_password(legacy, "secret")
+    assert needs_rehash(legacy)
+
+
+def test_changed_iterations_need_rehash():
+    stored = hash_password("secret")
+    assert not needs_rehash(stored)
+    iterations = passwords.settings["iterations"]
+    passwords.configure(iterations=1000)
+    try:
+        assert needs_rehash(stored)
+        assert verify_password(stored, "secret")
+    finally:
+        passwords.configure(iterations=iterations)
+
+
+def test_worker_pool():
+    passwords.configure(workers=1)
+    try:
+        assert verify_password(hash_password("secret"), "secret")
+    finally:
+        passwords.configure(workers=0)
+
+
+def test_workers_are_spawned():
+    passwords.configure(workers=1)
+    try:
+        # forking would copy the app's threads' locks and connections
+        assert passwords.executor._mp_context.get_start_method() == "spawn"
+        assert passwords.executor.submit(os.getpid).result() != os.getpid()
+    finally:
+        passwords.configure(workers=0)
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from .cache import LRUCache
+
+
+class RateLimiter:
+    """
+    A token bucket per key: each key may make `burst` requests at once,
+    and gets back `rate` requests per second after that. Only the
+    `maxsize` most recently seen keys are remembered.
+
+    `take(key)` spends one token and returns 0, or returns how many
+    seconds to wait until a token is available.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.limited = 0
+        self._buckets = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+            self.limited += 1
+            return (1 - tokens) / self.rate
+
+
+class AuthLimits:
+    """
+    The limits on requests that hash a password: a RateLimiter per
+    client IP and one per username, either of which may be None for no
+    limit, and a cap of `max_concurrent` password hashes at a time.
+    """
+
+    def __init__(self, by_ip=None, by_username=None, max_concurrent=None):
+        self.by_ip = by_ip
+        self.by_username = by_username
+        self.max_concurrent = max_concurrent
+        self.busy = 0
+        self._slots = (threading.BoundedSemaphore(max_concurrent)
+                       if max_concurrent else None)
+
+    def check(self, ip, username):
+        """
+        Spend a token from the buckets for `ip` and `username` and return
+        0, or the number of seconds to wait if either is empty.
+        """
+        if self.by_ip is not None:
+            retry_after = self.by_ip.take(ip)
+            if retry_after:
+                return retry_after
+        if self.by_username is not None and username:
+            return self.by_username.take(username)
+        return 0
+
+    def acquire(self):
+        """Take a hashing slot if one is free, without waiting."""
+        if self._slots is None or self._slots.acquire(blocking=False):
+            return True
+        self.busy += 1
+        return False
+
+    def release(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "ip": self.by_ip.limited if self.by_ip else 0,
+            "username": self.by_username.limited if self.by_username else 0,
+            "busy": self.busy
+        }
+
+
+def make_limiter(rate, burst, maxsize):
+    if rate is None:
+        return None
+    return RateLimiter(rate, burst, maxsize=maxsize)
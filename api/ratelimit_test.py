@@ -0,0 +1,80 @@
+import pytest
+
+from . import passwords
+from .app import create_app
+from .ratelimit import AuthLimits, RateLimiter
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_buckets_refill_at_their_rate():
+    clock = Clock()
+    limiter = RateLimiter(rate=0.5, burst=2, clock=clock)
+    assert limiter.take("a") == 0
+    assert limiter.take("a") == 0
+    assert limiter.take("a") == 2
+    assert limiter.take("b") == 0
+
+    clock.now = 1
+    assert limiter.take("a") == 1
+    clock.now = 2
+    assert limiter.take("a") == 0
+    assert limiter.limited == 2
+
+
+def test_hashing_slots_do_not_wait():
+    limits = AuthLimits(max_concurrent=1)
+    assert limits.acquire()
+    assert not limits.acquire()
+    limits.release()
+    assert limits.acquire()
+    assert limits.stats()["busy"] == 1
+
+
+@pytest.fixture
+def client(tmp_path, make_client):
+    app = create_app({
+        "DATABASE": tmp_path / "test.sqlite3",
+        "PASSWORD_HASH_ITERATIONS": 1,
+        "PASSWORD_HASH_WORKERS": 0,
+        "AUTH_IP_RATE": 0.001,
+        "AUTH_IP_BURST": 4,
+        "AUTH_USERNAME_RATE": 0.001,
+        "AUTH_USERNAME_BURST": 2
+    })
+    return make_client(app)
+
+
+def test_limited_logins_are_refused_before_hashing(client, monkeypatch):
+    credentials = {"username": "alice", "password": "secret"}
+    assert client.post("/auth/user/", json=credentials).status_code == 201
+    assert client.post("/auth/token/", json=credentials).status_code == 200
+
+    hashes = []
+    monkeypatch.setattr(passwords, "run_kdf",
+                        lambda *args: hashes.append(args))
+    response = client.post("/auth/token/", json=credentials)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert hashes == []
+
+    # bob has tokens left, but this client has used up its burst
+    response = client.post("/auth/user/",
+                           json={
+                               "username": "bob",
+                               "password": "secret"
+                           })
+    assert response.status_code == 201
+    response = client.post("/auth/token/",
+                           json={
+                               "username": "bob",
+                               "password": "secret"
+                           })
+    assert response.status_code == 429
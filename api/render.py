@@ -0,0 +1,120 @@
+import html
+import urllib.parse
+import xml.etree.ElementTree as etree
+
+import markdown
+from markdown.extensions import Extension
+from markdown.inlinepatterns import InlineProcessor
+from markdown.treeprocessors import Treeprocessor
+
+from .cache import LRUCache
+
+
+class WikiLinkProcessor(InlineProcessor):
+    """
+    Turn [[label|target]] links into anchors to the target page, with
+    a `missing` class when the target page does not exist.
+    """
+
+    def __init__(self, existing_titles, md=None):
+        super().__init__(r"\[\[([^\n]*?)\]\]", md)
+        self.existing_titles = existing_titles
+
+    def handleMatch(self, match, data):
+        text = match.group(1)
+        label, _, target = text.partition("|")
+        if "|" not in text:
+            target = text
+        if not label or not target:
+            return None, None, None
+
+        link = etree.Element("a")
+        link.text = label
+        link.set("href", f"/pages/{urllib.parse.quote(target)}/")
+        classes = "wiki-link"
+        if target not in self.existing_titles:
+            classes += " missing"
+        link.set("class", classes)
+        return link, match.start(0), match.end(0)
+
+
+class SafeLinkProcessor(Treeprocessor):
+    """
+    Drop link and image URLs with a scheme outside `SAFE_SCHEMES`, such
+    as `javascript:`, leaving relative URLs alone.
+    """
+    SAFE_SCHEMES = {"http", "https", "mailto"}
+    URL_ATTRIBUTES = {"a": "href", "img": "src"}
+
+    def run(self, root):
+        for element in root.iter():
+            attribute = self.URL_ATTRIBUTES.get(element.tag)
+            url = element.get(attribute) if attribute else None
+            if url is not None and not self.is_safe(url):
+                del element.attrib[attribute]
+
+    @classmethod
+    def is_safe(cls, url):
+        # character references in the attribute, such as &#58; for ":",
+        # are decoded by the browser before it reads the scheme, and
+        # whitespace and control characters in the scheme are ignored
+        url = "".join(char for char in html.unescape(url)
+                      if char > " " and char != "\x7f")
+        scheme, colon, rest = url.partition(":")
+        if not colon or any(char in scheme for char in "/?#"):
+            return True
+        return scheme.lower() in cls.SAFE_SCHEMES
+
+
+class WikiExtension(Extension):
+    """
+    Render wiki links, escape raw HTML and drop unsafe link URLs in page
+    bodies.
+    """
+
+    def __init__(self, existing_titles):
+        super().__init__()
+        self.existing_titles = existing_titles
+
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        md.inlinePatterns.register(
+            WikiLinkProcessor(self.existing_titles, md), "wiki_link", 175)
+        md.treeprocessors.register(SafeLinkProcessor(md), "safe_link", 5)
+
+
+def render_markdown(body, existing_titles):
+    """
+    Render a page body to HTML. `existing_titles` is the set of link
+    targets that are existing pages.
+    """
+    return markdown.markdown(body,
+                             extensions=[WikiExtension(existing_titles)])
+
+
+class RenderCache:
+    """
+    A bounded cache of rendered HTML keyed by page version id. Since
+    versions never change, an entry only goes stale when a page it links
+    to is created, renamed or deleted, so each entry keeps its set of
+    link targets and `forget_title` drops the entries that link to a
+    title.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.entries = LRUCache(maxsize=maxsize)
+
+    def get(self, version_id):
+        entry = self.entries.get(version_id)
+        if entry is not None:
+            return entry[0]
+
+    def set(self, version_id, html, targets):
+        self.entries.set(version_id, (html, frozenset(targets)))
+
+    def forget_title(self, title):
+        self.entries.evict(lambda version_id, entry: title in entry[1])
+
+    def stats(self):
+        return self.entries.stats()
@@ -0,0 +1,38 @@
+from .render import RenderCache, render_markdown
+
+
+def test_render_wiki_links():
+    html = render_markdown("[[Python]] and [[a language|Ruby]]", {"Python"})
+    assert html == ('<p><a class="wiki-link" href="/pages/Python/">Python</a>'
+                    ' and <a class="wiki-link missing" href="/pages/Ruby/">'
+                    'a language</a></p>')
+
+
+def test_render_escapes_raw_html():
+    assert render_markdown("<b>hi</b>", set()) == "<p>&lt;b&gt;hi&lt;/b&gt;</p>"
+
+
+def test_render_drops_unsafe_link_urls():
+    assert render_markdown("[x](javascript:alert(1))", set()) == \
+        "<p><a>x</a></p>"
+    assert render_markdown("[x](JavaScript\t:alert(1))", set()) == \
+        "<p><a>x</a></p>"
+    assert render_markdown("![x](data:image/svg+xml,<svg>)", set()) == \
+        '<p><img alt="x" /></p>'
+    for url in ["&#106;avascript:alert(1)", "javascript&#58;alert(1)",
+                "javascript&colon;alert(1)"]:
+        assert render_markdown(f"[x]({url})", set()) == "<p><a>x</a></p>"
+        assert render_markdown(f"![x]({url})", set()) == \
+            '<p><img alt="x" /></p>'
+    assert render_markdown("[x](https://example.com) [y](/pages/a:b/)",
+                           set()) == ('<p><a href="https://example.com">x</a>'
+                                      ' <a href="/pages/a:b/">y</a></p>')
+
+
+def test_forget_title_drops_renders_linking_to_it():
+    cache = RenderCache()
+    cache.set(1, "one", {"Python"})
+    cache.set(2, "two", {"Ruby"})
+    cache.forget_title("Python")
+    assert cache.get(1) is None
+    assert cache.get(2) == "two"
@@ -0,0 +1,189 @@
+"""
+Thinning out old page history and giving the space back.
+
+A `RetentionPolicy` decides which versions of a page to keep by their
+age. `compact_history` works out how to delete the others without the
+write lock, then writes the result in small batches, each in its own
+short write transaction, and `incremental_vacuum` then returns the
+freed pages to the file system in small steps, so that neither holds
+the write lock long enough to stall requests.
+"""
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from .data import PageVersion, UnitOfWork
+
+DAY = timedelta(days=1)
+
+
+class RetentionPolicy:
+    """
+    Keep every version saved in the last `keep_all_days` days, then the
+    last version of each day up to `keep_daily_days` days old, then the
+    last version of each month up to `keep_monthly_days` days old, or
+    forever if that is None. The newest version of a page is always kept.
+    """
+
+    def __init__(self,
+                 keep_all_days=30,
+                 keep_daily_days=365,
+                 keep_monthly_days=None):
+        self.keep_all_days = keep_all_days
+        self.keep_daily_days = keep_daily_days
+        self.keep_monthly_days = keep_monthly_days
+
+    def bucket(self, version_id, saved_at, now):
+        """
+        Return the bucket of a version saved at `saved_at`, of which only
+        the newest version is kept: its own bucket for versions that are
+        all kept, and None for versions that are all removed.
+        """
+        age = now - saved_at
+        if age < self.keep_all_days * DAY:
+            return ("version", version_id)
+        if age < self.keep_daily_days * DAY:
+            return ("day", saved_at.date())
+        if (self.keep_monthly_days is None
+                or age < self.keep_monthly_days * DAY):
+            return ("month", saved_at.year, saved_at.month)
+        return None
+
+    def versions_to_remove(self, versions, now):
+        """
+        Given the (id, saved_at) of every version of a page, oldest
+        first, return the ids of the versions to remove.
+        """
+        newest = {}
+        for version_id, saved_at in versions[:-1]:
+            bucket = self.bucket(version_id, saved_at, now)
+            if bucket is not None:
+                newest[bucket] = version_id
+        kept = set(newest.values())
+        return [
+            version_id for version_id, _ in versions[:-1]
+            if version_id not in kept
+        ]
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def find_removable_versions(db, policy, now=None):
+    """
+    Return a dict mapping page ids to the ids of their versions that
+    `policy` would remove.
+    """
+    now = now or datetime.now()
+    rows = db.execute(f"""
+        SELECT page_id, id, saved_at FROM {PageVersion.table_name}
+        ORDER BY page_id, id""")
+    removable = {}
+    for page_id, versions in groupby(rows, key=lambda row: row[0]):
+        versions = [(version_id, parse_timestamp(saved_at))
+                    for _, version_id, saved_at in versions]
+        version_ids = policy.versions_to_remove(versions, now)
+        if version_ids:
+            removable[page_id] = version_ids
+    return removable
+
+
+def compact_history(db,
+                    policy,
+                    now=None,
+                    batch_versions=200,
+                    batch_bytes=1024 * 1024,
+                    pause=0.05):
+    """
+    Remove the versions that `policy` does not keep. Each page's bodies
+    are restored and its deltas made outside of any transaction; the
+    results are then written in batches of about `batch_versions`
+    deleted or rewritten versions, or `batch_bytes` bytes of rewritten
+    bodies and deltas, whichever comes first. Each batch is one
+    transaction, and `pause` seconds pass between transactions so that
+    requests waiting to write get their turn. Pages that change in the
+    meantime are left for the next run. `db` must be a pooled connection
+    outside of a request.
+
+    Returns a tuple of the number of pages compacted and the number of
+    versions removed.
+    """
+    pages = removed = batches = 0
+    batch, versions, size = [], 0, 0
+    removable = find_removable_versions(db, policy, now)
+    for number, (page_id, version_ids) in enumerate(removable.items(), 1):
+        plan = PageVersion.plan_removal(db, page_id, version_ids)
+        batch.append(plan)
+        versions += len(plan.removed) + len(plan.updates)
+        size += sum(
+            len(body or "") + len(delta or "")
+            for body, delta, _ in plan.updates)
+        if (versions < batch_versions and size < batch_bytes
+                and number < len(removable)):
+            continue
+        if batches and pause:
+            time.sleep(pause)
+        batch_pages, batch_removed = apply_removals(db, batch)
+        batches += 1
+        pages += batch_pages
+        removed += batch_removed
+        batch, versions, size = [], 0, 0
+    return pages, removed
+
+
+def apply_removals(db, plans):
+    """
+    Write the `PageVersion.plan_removal` plans of a batch in one
+    transaction. Returns the number of pages compacted and of versions
+    removed.
+    """
+    pages = removed = 0
+    # the unit of work keeps the models from committing each page
+    unit_of_work = db.unit_of_work = UnitOfWork()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for plan in plans:
+            count = PageVersion.apply_removal(db, plan)
+            if count:
+                pages += 1
+                removed += count
+    except Exception:
+        unit_of_work.rollback(db)
+        raise
+    else:
+        unit_of_work.commit(db)
+    finally:
+        db.unit_of_work = None
+    return pages, removed
+
+
+def database_size(db):
+    page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    return page_size * page_count
+
+
+def incremental_vacuum(db, step=256, pause=0.05):
+    """
+    Return the database's free pages to the file system, `step` pages
+    per transaction. This needs `auto_vacuum` to be `incremental`, which
+    only takes effect on an existing database after a full VACUUM.
+
+    Returns the number of bytes reclaimed, or None if the database is
+    not in incremental vacuum mode.
+    """
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return None
+    size = database_size(db)
+    while db.execute("PRAGMA freelist_count").fetchone()[0]:
+        # execute() would stop after freeing the first page, as the pragma
+        # returns no rows; executescript() runs it to the end
+        db.executescript(f"PRAGMA incremental_vacuum({int(step)})")
+        if pause:
+            time.sleep(pause)
+    # move the truncated pages out of the write-ahead log, if there is one
+    db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return size - database_size(db)
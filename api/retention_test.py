@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from . import retention
+from .data import Page, PageVersion
+from .db import ConnectionPool
+from .migrations import upgrade
+from .retention import (RetentionPolicy, compact_history,
+                        find_removable_versions, incremental_vacuum)
+
+NOW = datetime(2024, 6, 30, 12)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(PageVersion, "keyframe_interval", 3)
+    pool = ConnectionPool(tmp_path / "test.sqlite3",
+                          pragmas={
+                              "auto_vacuum": "incremental",
+                              "journal_mode": "wal"
+                          })
+    db = pool.acquire()
+    upgrade(db)
+    yield db
+    pool.release(db)
+    pool.close()
+
+
+def add_history(db, title, ages):
+    """
+    Create a page with one version per age, oldest first, each saved
+    that long before NOW.
+    """
+    page = Page.create_with_body(db, title=title, body=f"{title} 0")
+    for number in range(1, len(ages)):
+        page.add_version(db, f"{title} {number}\n" + "text " * 200)
+    versions = PageVersion.select(db, "WHERE page_id = ? ORDER BY id",
+                                  [page.id])
+    with db:
+        db.executemany(
+            "UPDATE page_versions SET saved_at = ? WHERE id = ?",
+            [[NOW - age, version.id] for version, age in zip(versions, ages)])
+    return page
+
+
+def test_policy_thins_versions_by_age():
+    policy = RetentionPolicy(keep_all_days=7,
+                             keep_daily_days=60,
+                             keep_monthly_days=365)
+    versions = list(
+        enumerate([
+            NOW - timedelta(days=400),
+            NOW - timedelta(days=200, hours=2),
+            NOW - timedelta(days=200, hours=1),
+            NOW - timedelta(days=30, hours=2),
+            NOW - timedelta(days=30, hours=1),
+            NOW - timedelta(days=2, hours=2),
+            NOW - timedelta(days=2, hours=1),
+            NOW
+        ]))
+    assert policy.versions_to_remove(versions, NOW) == [0, 1, 3]
+
+
+def test_compaction_keeps_delta_chains_valid(db):
+    ages = [timedelta(days=days, hours=hours)
+            for days, hours in [(90, 3), (90, 2), (90, 1), (60, 2), (60, 1),
+                                (40, 0), (1, 1), (0, 0)]]
+    home = add_history(db, "Home", ages)
+    add_history(db, "Recent", [timedelta(0)] * 3)
+    policy = RetentionPolicy(keep_all_days=7, keep_daily_days=365)
+
+    assert compact_history(db, policy, now=NOW, pause=0) == (1, 3)
+    assert find_removable_versions(db, policy, now=NOW) == {}
+
+    history = Page.get(db, home.id).with_history(db).history
+    assert [version.body.split("\n")[0] for version in history] == \
+        ["Home 7", "Home 6", "Home 5", "Home 4", "Home 2"]
+    stored = PageVersion.select(db, "WHERE page_id = ? ORDER BY id",
+                                [home.id])
+    assert [version.delta is None for version in stored] == \
+        [True, False, False, True, False]
+    assert stored[-1].body is not None
+
+
+def test_compaction_is_batched_by_versions(db, monkeypatch):
+    for title in ["A", "B", "C"]:
+        add_history(db, title, [timedelta(days=900)] * 3)
+    batches = []
+    apply_removals = retention.apply_removals
+
+    def record_batch(db, plans):
+        assert not db.in_transaction
+        batches.append([plan.page_id for plan in plans])
+        return apply_removals(db, plans)
+
+    monkeypatch.setattr(retention, "apply_removals", record_batch)
+    policy = RetentionPolicy(keep_all_days=1,
+                             keep_daily_days=1,
+                             keep_monthly_days=1)
+    assert compact_history(db, policy, now=NOW, batch_versions=4,
+                           pause=0) == (3, 6)
+    assert [len(batch) for batch in batches] == [2, 1]
+
+
+def test_pages_changed_while_planning_are_skipped(db, monkeypatch):
+    page = add_history(db, "Home", [timedelta(days=900)] * 3)
+    plan_removal = PageVersion.plan_removal
+
+    def edit_after_planning(db, page_id, version_ids):
+        plan = plan_removal(db, page_id, version_ids)
+        Page.get(db, page_id).add_version(db, "Edited")
+        return plan
+
+    monkeypatch.setattr(PageVersion, "plan_removal", edit_after_planning)
+    policy = RetentionPolicy(keep_all_days=1,
+                             keep_daily_days=1,
+                             keep_monthly_days=1)
+    assert compact_history(db, policy, now=NOW, pause=0) == (0, 0)
+    history = Page.get(db, page.id).with_history(db).history
+    assert [version.body.split("\n")[0] for version in history] == \
+        ["Edited", "Home 2", "Home 1", "Home 0"]
+
+
+def test_newest_version_is_never_removed(db):
+    page = add_history(db, "Home", [timedelta(days=900)] * 2)
+    newest = PageVersion.select(db, "WHERE page_id = ? ORDER BY id DESC",
+                                [page.id])[0]
+    with pytest.raises(ValueError):
+        PageVersion.remove_versions(db, page.id, [newest.id])
+
+
+def test_incremental_vacuum_reports_bytes_reclaimed(db):
+    add_history(db, "Home", [timedelta(days=400 - day) for day in range(40)])
+    compact_history(db,
+                    RetentionPolicy(keep_all_days=1,
+                                    keep_daily_days=2,
+                                    keep_monthly_days=3),
+                    now=NOW,
+                    pause=0)
+    assert incremental_vacuum(db, step=1, pause=0) > 0
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
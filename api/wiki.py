@@ -1,3 +1,6 @@
+import re
+
+
 def check_wiki_link(candidate):
     """
     Given a string, detect if it is a valid wiki link. A wiki link should
@@ -26,14 +29,84 @@ def check_wiki_link(candidate):
 
 
 def check_wiki_word(candidate):
-    if len(candidate) < 2 or not all([char.isalnum() for char in candidate]):
+    if len(candidate) < 2 or not candidate.isalnum():
         return None
 
-    if not candidate[0].isupper():
-        return None
-
-    if not (any([char.isupper() for char in candidate[1:]]) and
-            any([char.islower() for char in candidate[1:]])):
+    if not is_camel_case(candidate):
         return None
 
     return {"label": candidate, "target": candidate}
+
+
+def is_camel_case(word):
+    """
+    Check that a word starts with an uppercase letter and has both
+    uppercase and lowercase letters after it.
+    """
+    if not word[0].isupper():
+        return False
+    rest = word[1:]
+    return (any(char.isupper() for char in rest) and
+            any(char.islower() for char in rest))
+
+
+# A link runs from "[[" to the first "]]" on the same line. A wiki word
+# candidate is a whole run of two or more alphanumeric characters that
+# does not start with a digit or an ASCII lowercase letter; the rest of
+# the wiki word rules are checked in Python on these candidates.
+WIKI_MARKUP = re.compile(r"""
+    \[\[ (?P<text>[^\n]*?) \]\]
+    | (?<![^\W_]) (?P<word>[^\W\d_a-z][^\W_]+)
+""", re.VERBOSE)
+
+# For ASCII bodies, which are the common case, the regular expression
+# checks all of the wiki word rules itself, so ordinary capitalized
+# words never become candidates.
+ASCII_WIKI_MARKUP = re.compile(r"""
+    \[\[ (?P<text>[^\n]*?) \]\]
+    | (?<![A-Za-z0-9])
+      (?P<word>[A-Z] (?=[A-Za-z0-9]*?[A-Z]) (?=[A-Za-z0-9]*?[a-z])
+               [A-Za-z0-9]+)
+""", re.VERBOSE)
+
+
+def iter_wiki_links(body):
+    """
+    Scan a page body once and yield every wiki link and wiki word in
+    it, in order. Each result is a dictionary like the ones returned by
+    `check_wiki_link` and `check_wiki_word`, plus the `kind` ("link" or
+    "word") and the `start` and `end` offsets of the markup in the body.
+    Wiki words inside link brackets are not reported on their own.
+    """
+    is_ascii = body.isascii()
+    pattern = ASCII_WIKI_MARKUP if is_ascii else WIKI_MARKUP
+    for match in pattern.finditer(body):
+        text = match.group("text")
+        if text is not None:
+            label, _, target = text.partition("|")
+            if "|" not in text:
+                target = text
+            if not label or not target:
+                continue
+            kind = "link"
+        else:
+            label = target = match.group("word")
+            if not is_ascii and not is_camel_case(label):
+                continue
+            kind = "word"
+
+        yield {
+            "label": label,
+            "target": target,
+            "kind": kind,
+            "start": match.start(),
+            "end": match.end()
+        }
+
+
+def scan_wiki_links(body):
+    """
+    Return a list of every wiki link and wiki word in a page body. See
+    `iter_wiki_links`.
+    """
+    return list(iter_wiki_links(body))
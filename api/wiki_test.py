@@ -1,4 +1,4 @@
-from .wiki import check_wiki_link, check_wiki_word
+from .wiki import check_wiki_link, check_wiki_word, scan_wiki_links
 
 
 def test_bad_links():
@@ -36,3 +36,47 @@ def test_good_wiki_words():
         "label": "TestWord1",
         "target": "TestWord1"
     }
+
+
+def test_scan_wiki_links():
+    body = ("Python is [[dynamically typed|Dynamic programming language]]"
+            " like [[JavaScript]], see TestWord, not testWord or Test.")
+    assert scan_wiki_links(body) == [{
+        "label": "dynamically typed",
+        "target": "Dynamic programming language",
+        "kind": "link",
+        "start": 10,
+        "end": 60
+    }, {
+        "label": "JavaScript",
+        "target": "JavaScript",
+        "kind": "link",
+        "start": 66,
+        "end": 80
+    }, {
+        "label": "TestWord",
+        "target": "TestWord",
+        "kind": "word",
+        "start": 86,
+        "end": 94
+    }]
+
+
+def check_scan_results(body):
+    results = scan_wiki_links(body)
+    for result in results:
+        candidate = body[result["start"]:result["end"]]
+        check = check_wiki_link if result["kind"] == "link" else check_wiki_word
+        assert check(candidate) == {
+            "label": result["label"],
+            "target": result["target"]
+        }
+    return [result["label"] for result in results]
+
+
+def test_scan_matches_check_functions():
+    body = ("[[]] [[|]] [[Hello|]] [[|Hello]] [[Hello|Hi]] [[a||b]] [[x\ny]]"
+            " 1TestWord Test-Word TestWord1 TESTWORD _TestWord TestWord_ XyZ")
+    labels = ["Hello", "a", "TestWord1", "TestWord", "TestWord", "XyZ"]
+    assert check_scan_results(body) == labels
+    assert check_scan_results(body + " ÉtéHiver Été") == labels + ["ÉtéHiver"]
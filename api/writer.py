@@ -0,0 +1,172 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .data import UnitOfWork
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    """
+    Runs writes on one dedicated connection in a writer thread, so that
+    requests never contend for SQLite's write lock.
+
+    `submit(job)` queues `job(db)` and waits for its result. The writer
+    runs every job queued within `window` seconds of the first, up to
+    `max_batch` jobs, in one transaction, with a savepoint around each job
+    so that a failing job is rolled back on its own, then commits once and
+    hands back the results. Each job gets its own unit of work, so the
+    models' `with db:` blocks do not commit, and its after-commit
+    callbacks run after the group commit, once the results are handed
+    back. A callback that raises is logged and does not stop the writer.
+    """
+
+    def __init__(self, connect, window=0.001, max_batch=64):
+        self.connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="db-writer",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, job, query_log=None):
+        """
+        Run `job(db)` on the writer connection and return its result, or
+        raise its exception, once the batch it ran in is committed.
+        `query_log` records the job's statements. Raises RuntimeError if
+        the writer thread has stopped.
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("The database writer has stopped")
+            self._queue.put((job, query_log, future))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return {"batches": self.batches, "jobs": self.jobs}
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        try:
+            db = self.connect()
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch is None:
+                        return
+                    self._run_batch(db, batch)
+            finally:
+                db.close()
+        except Exception:
+            logger.exception("The database writer stopped")
+        finally:
+            self._stop()
+
+    def _stop(self):
+        """
+        Refuse new jobs and fail the ones still queued, so that no caller
+        waits on a writer that is gone.
+        """
+        with self._lock:
+            self._stopped = True
+        error = RuntimeError("The database writer has stopped")
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[2].set_running_or_notify_cancel():
+                item[2].set_exception(error)
+
+    def _run_batch(self, db, batch):
+        results = []
+        callbacks = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for job, query_log, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                outcome, unit_of_work = self._run_job(db, job, query_log)
+                results.append((future, outcome))
+                if unit_of_work is not None:
+                    callbacks.extend(unit_of_work.callbacks)
+            db.commit()
+        except Exception as error:
+            if db.in_transaction:
+                db.rollback()
+            for future, _ in results:
+                future.set_exception(error)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.jobs += len(results)
+        for future, (result, error) in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("After-commit callback %r failed", callback)
+
+    def _run_job(self, db, job, query_log):
+        """
+        Run one job in a savepoint. Returns ((result, error), unit of
+        work), where the unit of work is None if the job was rolled back.
+        """
+        unit_of_work = UnitOfWork()
+        db.unit_of_work = unit_of_work
+        db.query_log = query_log
+        db.execute("SAVEPOINT job")
+        try:
+            result = job(db)
+        except Exception as error:
+            db.execute("ROLLBACK TO job")
+            db.execute("RELEASE job")
+            return (None, error), None
+        finally:
+            db.unit_of_work = None
+            db.query_log = None
+
+        if unit_of_work.failed:
+            db.execute("ROLLBACK TO job")
+            db.execute("RELEASE job")
+            return (result, None), None
+        db.execute("RELEASE job")
+        return (result, None), unit_of_work
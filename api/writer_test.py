@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+
+import pytest
+
+from .db import ConnectionPool
+from .writer import WriteQueue
+
+
+@pytest.fixture
+def writer(tmp_path):
+    pool = ConnectionPool(tmp_path / "test.sqlite3",
+                          pragmas={"journal_mode": "wal"})
+    db = pool.acquire()
+    with db:
+        db.execute("CREATE TABLE things (name TEXT UNIQUE)")
+    pool.release(db)
+    writer = WriteQueue(pool.connect, window=0.05)
+    yield writer, pool
+    writer.close()
+    pool.close()
+
+
+def insert(name):
+
+    def job(db):
+        with db:
+            db.execute("INSERT INTO things VALUES (?)", [name])
+        return name
+
+    return job
+
+
+def test_writes_are_group_committed(writer):
+    writer, pool = writer
+    results = []
+    threads = [
+        threading.Thread(target=lambda n=n: results.append(
+            writer.submit(insert(f"thing {n}")))) for n in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [f"thing {n}" for n in range(5)]
+    assert writer.stats()["jobs"] == 5
+    assert writer.stats()["batches"] < 5
+    db = pool.acquire()
+    assert db.execute("SELECT COUNT(*) FROM things").fetchone()[0] == 5
+
+
+def test_failed_job_is_rolled_back_alone(writer):
+    writer, pool = writer
+    writer.submit(insert("a"))
+
+    def fails(db):
+        insert("b")(db)
+        insert("a")(db)
+
+    with pytest.raises(Exception):
+        writer.submit(fails)
+    writer.submit(insert("c"))
+    db = pool.acquire()
+    assert [row[0] for row in db.execute("SELECT name FROM things")
+            ] == ["a", "c"]
+
+
+def test_failing_callback_does_not_stop_the_writer(writer):
+    writer, pool = writer
+
+    def fails_after_commit(db):
+        db.unit_of_work.after_commit(lambda: 1 / 0)
+        return insert("a")(db)
+
+    assert writer.submit(fails_after_commit) == "a"
+    assert writer.submit(insert("b")) == "b"
+
+
+def test_submit_fails_once_the_writer_has_stopped(tmp_path):
+
+    def connect():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    writer = WriteQueue(connect)
+    writer._thread.join()
+    with pytest.raises(RuntimeError):
+        writer.submit(insert("a"))
@@ -0,0 +1,87 @@
+"""
+Build synthetic wikis for benchmarks with the wiki's own models.
+"""
+import random
+from itertools import islice
+
+from api.data import Page, PageVersion, User
+
+WORDS = [
+    "the", "wiki", "page", "language", "of", "and", "typed", "dynamic",
+    "1991", "code", "a", "is", "in", "to", "programming", "with", "for",
+    "The", "runtime", "features", "many", "It", "object", "system", "that",
+    "by", "as", "performance", "WikiWord", "CamelCase"
+]
+
+
+def page_title(number):
+    return f"Page {number}"
+
+
+def make_body(rng, size, titles, link_density=0.02, missing_links=0.1):
+    """
+    Make a body of about `size` characters where about `link_density`
+    of the words are [[links]] to one of `titles`, or to a missing page
+    for `missing_links` of the links.
+    """
+    parts = []
+    length = 0
+    while length < size:
+        if rng.random() < link_density:
+            if rng.random() < missing_links or not titles:
+                target = f"Missing {rng.randrange(1000)}"
+            else:
+                target = rng.choice(titles)
+            part = f"[[{target}]]"
+        else:
+            part = rng.choice(WORDS)
+        parts.append(part)
+        length += len(part) + 1
+        if rng.random() < 0.05:
+            parts.append("\n\n")
+    return " ".join(parts)
+
+
+def generate_wiki(db,
+                  pages=1000,
+                  versions=5,
+                  body_size=2048,
+                  link_density=0.02,
+                  users=10,
+                  password="benchmark",
+                  seed=0,
+                  batch_size=500):
+    """
+    Fill a database with `pages` pages of `versions` versions each, with
+    bodies of about `body_size` characters that link to other pages with
+    `link_density`, and `users` users sharing `password`.
+
+    The same arguments always build the same wiki. Returns the users.
+    """
+    rng = random.Random(seed)
+    titles = [page_title(number) for number in range(pages)]
+
+    created_users = [
+        User(username=f"user{number}", password=password)
+        for number in range(users)
+    ]
+    for user in created_users:
+        user.save(db)
+    user_ids = [user.id for user in created_users]
+
+    numbers = iter(range(pages))
+    while True:
+        batch = [Page(title=titles[number])
+                 for number in islice(numbers, batch_size)]
+        if not batch:
+            break
+        saved = Page.save_many(db, batch)
+        for _ in range(versions):
+            PageVersion.save_many(db, [
+                PageVersion(page_id=page.id,
+                            body=make_body(rng, body_size, titles,
+                                           link_density),
+                            user_id=rng.choice(user_ids) if user_ids else None)
+                for page in saved
+            ])
+    return created_users
@@ -0,0 +1,213 @@
+"""
+Benchmark the wiki API end to end on a synthetic wiki.
+
+Run with `python -m benchmarks.wiki_app [--pages N] [--output FILE]`. It
+builds a wiki with `benchmarks.synthetic`, then drives `create_app()`
+through the Flask test client over the list, detail, create, update,
+login and token auth paths, and writes the throughput and p50/p99
+latency of each to a JSON file. Pass `--compare OLD.json` to print the
+change from an earlier run.
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from api.app import create_app
+from api.db import get_db
+
+from .synthetic import generate_wiki, page_title
+
+PASSWORD = "benchmark"
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        "requests": len(latencies),
+        "seconds": total,
+        "throughput": len(latencies) / total if total else None,
+        "mean_ms": total / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+
+def run_scenario(client, make_request, requests, warmup):
+    """
+    Time `requests` calls of `make_request(client, number)` after
+    `warmup` untimed ones. Each call returns the response, which is read
+    and closed inside the timing, as a real client would.
+    """
+    latencies = []
+    for number in range(warmup + requests):
+        started = time.perf_counter()
+        response = make_request(client, number)
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f"request failed with {response.status_code}: "
+                f"{response.get_data(as_text=True)[:200]}")
+        if number >= warmup:
+            latencies.append(elapsed)
+    return latencies
+
+
+def scenarios(args, users):
+    rng = random.Random(args.seed)
+    headers = [{"Authorization": f"Token {user.token}"} for user in users]
+
+    def random_title():
+        return page_title(rng.randrange(args.pages))
+
+    return {
+        "list":
+        lambda client, number: client.get(f"/pages/?limit={args.page_size}"),
+        "list_fields":
+        lambda client, number: client.get(
+            f"/pages/?limit={args.page_size}&fields=id,title"),
+        "detail":
+        lambda client, number: client.get(
+            f"/pages/{random_title()}/?limit=10"),
+        "detail_html":
+        lambda client, number: client.get(
+            f"/pages/{random_title()}/?format=html"),
+        "create":
+        lambda client, number: client.post(
+            "/pages/",
+            json={
+                "title": f"Benchmark {args.seed} {number}",
+                "body": f"A new page linking to [[{random_title()}]]."
+            },
+            headers=headers[number % len(headers)]),
+        "update":
+        lambda client, number: client.put(
+            f"/pages/{random_title()}/",
+            json={"body": f"Edit {number} linking to [[{random_title()}]]."},
+            headers=headers[number % len(headers)]),
+        "login":
+        lambda client, number: client.post(
+            "/auth/token/",
+            json={
+                "username": users[number % len(users)].username,
+                "password": PASSWORD
+            }),
+        "token_auth":
+        lambda client, number: client.get(
+            "/auth/user/", headers=headers[number % len(headers)]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results):
+    for name, summary in results["scenarios"].items():
+        old = old_results["scenarios"].get(name)
+        if not old:
+            continue
+        change = (summary["throughput"] / old["throughput"] - 1) * 100
+        print(f"{name:>12}: {change:+6.1f}% throughput, p99 "
+              f"{old['p99_ms']:.2f} -> {summary['p99_ms']:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--body-size", type=int, default=2048)
+    parser.add_argument("--link-density", type=float, default=0.02)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--hash-iterations", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", action="append",
+                        help="Only run this scenario; can be repeated.")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            "DATABASE": Path(tmp) / "bench.sqlite3",
+            "PASSWORD_HASH_ITERATIONS": args.hash_iterations,
+            # the login scenario is one client logging in as fast as it can
+            "AUTH_IP_RATE": None,
+            "AUTH_USERNAME_RATE": None
+        })
+        started = time.perf_counter()
+        with app.app_context():
+            users = generate_wiki(get_db(),
+                                  pages=args.pages,
+                                  versions=args.versions,
+                                  body_size=args.body_size,
+                                  link_density=args.link_density,
+                                  users=args.users,
+                                  password=PASSWORD,
+                                  seed=args.seed)
+        print(f"Generated {args.pages} pages x {args.versions} versions in "
+              f"{time.perf_counter() - started:.1f}s")
+
+        results = {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "parameters": {
+                name: value
+                for name, value in vars(args).items()
+                if name not in ("output", "compare")
+            },
+            "scenarios": {}
+        }
+        client = app.test_client()
+        for name, make_request in scenarios(args, users).items():
+            if args.only and name not in args.only:
+                continue
+            summary = summarize(
+                run_scenario(client, make_request, args.requests,
+                             args.warmup))
+            results["scenarios"][name] = summary
+            print(f"{name:>12}: {summary['throughput']:8.1f} req/s "
+                  f"p50 {summary['p50_ms']:7.2f} ms "
+                  f"p99 {summary['p99_ms']:7.2f} ms")
+
+    output = args.output or Path(
+        "benchmarks/results") / f"{results['commit'] or 'latest'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Wrote {output}")
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark scanning large page bodies for wiki links and wiki words.
+
+Run with `python -m benchmarks.wiki_scan [--megabytes N]`. It compares
+`scan_wiki_links` with splitting the body into words and calling
+`check_wiki_link` and `check_wiki_word` on each one, after checking
+that both find the same links and words.
+"""
+import argparse
+import random
+import time
+
+from api.wiki import check_wiki_link, check_wiki_word, scan_wiki_links
+
+WORDS = [
+    "the", "wiki", "page", "Python", "language", "of", "and", "JavaScript",
+    "WikiWord", "typed", "dynamic", "CamelCase", "1991", "code", "a", "is",
+    "in", "to", "programming", "with", "for", "The", "runtime", "features",
+    "many", "It", "object", "system", "that", "by", "as", "performance"
+]
+
+
+def make_body(megabytes, link_density=0.02, seed=0):
+    """
+    Make a body of about `megabytes` MB where about `link_density` of
+    the words are [[label|target]] links. Labels have no spaces, so
+    that splitting on whitespace keeps each link whole.
+    """
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        if rng.random() < link_density:
+            part = f"[[{rng.choice(WORDS)}|{rng.choice(WORDS)}]]"
+        else:
+            part = rng.choice(WORDS)
+        parts.append(part)
+        size += len(part) + 1
+        if rng.random() < 0.05:
+            parts.append("\n\n")
+    return " ".join(parts)
+
+
+def split_and_check(body):
+    results = []
+    for token in body.split():
+        result = check_wiki_link(token) or check_wiki_word(token)
+        if result:
+            results.append(result)
+    return results
+
+
+def timed(function, body, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = function(body)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megabytes", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    body = make_body(args.megabytes)
+    size = len(body.encode()) / (1024 * 1024)
+    timings = {}
+    for function in [scan_wiki_links, split_and_check]:
+        timings[function.__name__] = timed(function, body, args.repeat)
+    # the timings only compare if both found the same links and words
+    found = [[(result["label"], result["target"]) for result in results]
+             for _, results in timings.values()]
+    assert found[0] == found[1], "the scans found different results"
+    for name, (elapsed, results) in timings.items():
+        print(f"{name:>16}: {elapsed * 1000:8.1f} ms "
+              f"{size / elapsed:7.1f} MB/s {len(results):8d} results")
+
+
+if __name__ == "__main__":
+    main()
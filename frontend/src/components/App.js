@@ -30,9 +30,19 @@ const App = () => {
   }
 
   useEffect(() => {
-    fetch('http://localhost:5000/pages/')
-      .then(response => response.json())
-      .then(data => setPages(data.pages))
+    // the list comes a page at a time; follow `next` until it runs out
+    const fetchPages = (after, pages) => {
+      const query = after === null ? '' : `?after=${after}`
+      return fetch(`http://localhost:5000/pages/${query}`)
+        .then(response => response.json())
+        .then(data => {
+          const allPages = pages.concat(data.pages)
+          return data.next === null ? allPages : fetchPages(data.next, allPages)
+        })
+    }
+
+    fetchPages(null, [])
+      .then(pages => setPages(pages))
       .catch(data => setError(true))
   }, [])
 